@@ -0,0 +1,107 @@
+import argparse
+import cProfile
+import os
+import pstats
+import random
+import tempfile
+import time
+from docx import Document
+from docx.oxml import parse_xml
+from docx.shared import Pt, RGBColor
+import docx2tei
+
+# Benchmark for docx2tei.py: convert generated DOCX files of growing size, and profile the
+# conversion of the largest one to see where the time goes
+
+
+def make_runs_document(filename, nparas):
+    """A long document of paragraphs with many differently formatted runs (about 40 paragraphs per page)."""
+    random.seed(1)
+    doc = Document()
+    colors = [RGBColor(0xFF, 0, 0), RGBColor(0, 0x80, 0), RGBColor(0, 0, 0xFF), None]
+    for i in range(nparas):
+        if i % 50 == 0:
+            doc.add_heading("Section " + str(i // 50 + 1), level=1)
+        para = doc.add_paragraph()
+        for k in range(random.randint(3, 12)):
+            run = para.add_run("word%d.%d " % (i, k))
+            style = random.randint(0, 5)
+            if style == 1:
+                run.bold = True
+            elif style == 2:
+                run.italic = True
+            elif style == 3:
+                run.font.color.rgb = colors[random.randrange(len(colors) - 1)]
+            elif style == 4:
+                run.font.size = Pt(random.choice([9, 10, 12, 14]))
+            elif style == 5:
+                run.style = random.choice(["Strong", "Emphasis"])
+    doc.save(filename)
+
+
+def make_table_document(filename, nrows, ncols=5):
+    """A document with one long table, with cells spanning two columns (gridSpan) and merged down (vMerge)."""
+    doc = Document()
+    doc.add_paragraph("Annex")
+    w = 'xmlns:w="' + docx2tei.namespaces["w"] + '"'
+    rows = []
+    for r in range(nrows):
+        cells = []
+        c = 0
+        while c < ncols:
+            props = ""
+            width = 1
+            if r % 10 == 0 and c == 1:
+                props = '<w:gridSpan w:val="2"/>'
+                width = 2
+            elif c == ncols - 1:
+                # The last column is merged down in groups of 4 rows
+                props = '<w:vMerge w:val="restart"/>' if r % 4 == 0 else "<w:vMerge/>"
+            text = f"r{r}c{c}" if "<w:vMerge/>" not in props else ""
+            cells.append(f"<w:tc><w:tcPr>{props}</w:tcPr><w:p><w:r><w:t>{text}</w:t></w:r></w:p></w:tc>")
+            c += width
+        rows.append("<w:tr>" + "".join(cells) + "</w:tr>")
+    grid = "".join("<w:gridCol/>" for c in range(ncols))
+    table = parse_xml(f"<w:tbl {w}><w:tblPr/><w:tblGrid>{grid}</w:tblGrid>" + "".join(rows) + "</w:tbl>")
+    doc.element.body.insert(len(doc.element.body) - 1, table)
+    doc.save(filename)
+
+
+def convert(docx_filename, profile=None):
+    """Convert a DOCX file to TEI in the same folder; returns the duration."""
+    tei_filename = os.path.splitext(docx_filename)[0] + ".xml"
+    image_dir = os.path.splitext(docx_filename)[0] + "_files"
+    converter = docx2tei.DocxConverter(docx_filename, tei_filename, image_dir)
+    start = time.perf_counter()
+    if profile is not None:
+        profile.runcall(converter.convert)
+    else:
+        converter.convert()
+    return time.perf_counter() - start
+
+
+parser = argparse.ArgumentParser(description="Benchmark docx2tei.py on generated DOCX files")
+parser.add_argument("what", help="runs: many formatted runs; table: one long table with merged cells", nargs="?", choices=["runs", "table"], default="runs")
+parser.add_argument("--sizes", help="comma separated document sizes in paragraphs (runs) or rows (table)", type=str, default="")
+parser.add_argument("--top", help="number of functions to show in the profile", type=int, default=15)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.what == "table":
+            make_document, unit, defaults = make_table_document, "rows", "2500,10000"
+        else:
+            make_document, unit, defaults = make_runs_document, "paragraphs", "5000,20000"
+        sizes = [int(size) for size in (args.sizes or defaults).split(",")]
+        for size in sizes:
+            docx_filename = os.path.join(tmpdir, args.what + "-" + str(size) + ".docx")
+            make_document(docx_filename, size)
+            duration = convert(docx_filename)
+            print(f"{size:8d} {unit}: {duration:8.3f} s  {1e6 * duration / size:8.1f} us/{unit[:-1]}")
+
+        # Profile the largest document
+        profile = cProfile.Profile()
+        convert(docx_filename, profile)
+        print()
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(args.top)
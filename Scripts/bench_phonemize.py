@@ -0,0 +1,39 @@
+from phonemizer.backend import EspeakBackend
+from phonemizer.separator import Separator
+import argparse
+import random, time
+
+# Benchmark for phonemize.py: compare transcribing the tokens one call at a time (as phonemize.py
+# used to) with a single batched call, with and without parallel espeak jobs and with each distinct
+# form only transcribed once (as phonemize_words does)
+
+parser = argparse.ArgumentParser(description="Compare per-token and batched phonemization throughput")
+parser.add_argument("-l", "--lang", help="espeak language", type=str, default="en-us")
+parser.add_argument("--tokens", help="number of tokens to transcribe", type=int, default=5000)
+parser.add_argument("-j", "--jobs", help="number of parallel espeak jobs for the batched call", type=int, default=4)
+args = parser.parse_args()
+
+def make_tokens(ntoks, nforms=2000):
+	# Pseudo-words with a Zipf-like frequency distribution, as in running text
+	random.seed(1)
+	syllables = ["ba", "ko", "ti", "ren", "sal", "mu", "der", "pi", "lon", "ves", "ga", "tro"]
+	forms = ["".join(random.choice(syllables) for k in range(random.randint(1, 4))) for i in range(nforms)]
+	weights = [1.0 / (rank + 1) for rank in range(nforms)]
+	return random.choices(forms, weights, k=ntoks)
+
+def timed(label, ntoks, function):
+	start = time.perf_counter()
+	function()
+	duration = time.perf_counter() - start
+	print("%-30s %8.3f s  %10.0f tokens/s" % (label, duration, ntoks / duration))
+
+backend = EspeakBackend(args.lang)
+separator = Separator(phone=" ", word=None)
+tokens = make_tokens(args.tokens)
+forms = list(dict.fromkeys(tokens))
+print(str(len(tokens)) + " tokens, " + str(len(forms)) + " distinct forms")
+
+timed("per token", len(tokens), lambda: [backend.phonemize([token], separator=separator, strip=True) for token in tokens])
+timed("batched", len(tokens), lambda: backend.phonemize(tokens, separator=separator, strip=True))
+timed("batched, " + str(args.jobs) + " jobs", len(tokens), lambda: backend.phonemize(tokens, separator=separator, strip=True, njobs=args.jobs))
+timed("batched, distinct forms", len(tokens), lambda: backend.phonemize(forms, separator=separator, strip=True, njobs=args.jobs))
@@ -0,0 +1,96 @@
+from cassis import *
+import argparse
+import os, random, tempfile, time
+from castypes import get_typesystem
+import readback_cas
+
+# Benchmark for readback_cas.py: read back a generated XMI with many NamedEntity spans
+# that do not start or end on token boundaries, and compare the bisect based snapping
+# of spans to tokens with stepping through the character offsets one at a time
+
+parser = argparse.ArgumentParser(description="Benchmark readback_cas.py on a generated XMI with many entity spans")
+parser.add_argument("--types", help="TypeSystem filename (default: as for readback_cas.py)", type=str)
+parser.add_argument("--spans", help="number of NamedEntity spans", type=int, default=100000)
+parser.add_argument("--tokens", help="number of tokens (default: twice the number of spans)", type=int)
+args = parser.parse_args()
+
+def step_span(begin, end, tokfrom, tokto, docend):
+	# The previous snapping: step one character at a time to the nearest token boundary
+	p1 = begin
+	while p1 > 0 and not p1 in tokfrom.keys():
+		p1 = p1 - 1
+	p2 = end
+	while p2 < docend and not p2 in tokto.keys():
+		p2 = p2 + 1
+	return tokfrom[p1], tokto[p2]
+
+def make_document(tmpdir, ntoks, nspans, typesystem):
+	# Tokens of varying length, and entity spans of 1-8 tokens with misaligned edges
+	random.seed(1)
+	words = ["w" + str(i) * random.randint(1, 4) for i in range(ntoks)]
+	offsets = []
+	pos = 0
+	for word in words:
+		offsets.append((pos, pos + len(word)))
+		pos = pos + len(word) + 1
+
+	cas = Cas(typesystem=typesystem)
+	cas.sofa_string = " ".join(words)
+	Token = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Token')
+	NamedEntity = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.ner.type.NamedEntity')
+	for i, (begin, end) in enumerate(offsets):
+		cas.add(Token(begin=begin, end=end, id="w-" + str(i+1)))
+	spans = []
+	for k in range(nspans):
+		first = random.randrange(ntoks)
+		last = min(first + random.randint(0, 7), ntoks - 1)
+		begin = offsets[first][0] + random.randint(0, len(words[first]) - 1)
+		end = offsets[last][1] - random.randint(0, len(words[last]) - 1)
+		spans.append((begin, end))
+		cas.add(NamedEntity(begin=begin, end=end, value="ENT"))
+	xmifile = os.path.join(tmpdir, "bench.xmi")
+	cas.to_xmi(xmifile)
+
+	xmlfile = os.path.join(tmpdir, "bench.xml")
+	with open(xmlfile, "w") as f:
+		f.write("<TEI><teiHeader/><text><s>")
+		f.write(" ".join('<tok id="w-%d">%s</tok>' % (i+1, word) for i, word in enumerate(words)))
+		f.write("</s></text></TEI>\n")
+	return xmlfile, xmifile, offsets, spans
+
+typesystem = get_typesystem(args.types)
+ntoks = args.tokens or 2 * args.spans
+with tempfile.TemporaryDirectory() as tmpdir:
+	start = time.perf_counter()
+	xmlfile, xmifile, offsets, spans = make_document(tmpdir, ntoks, args.spans, typesystem)
+	print("generated %d tokens and %d entity spans in %.1f s" % (ntoks, args.spans, time.perf_counter() - start))
+
+	# The snapping on its own
+	tokfrom = {}
+	tokto = {}
+	for i, (begin, end) in enumerate(offsets):
+		tokfrom[begin] = "w-" + str(i+1)
+		tokto[end] = "w-" + str(i+1)
+	docend = offsets[-1][1]
+	start = time.perf_counter()
+	stepped = [step_span(begin, end, tokfrom, tokto, docend) for begin, end in spans]
+	steptime = time.perf_counter() - start
+
+	begins = sorted(tokfrom.keys())
+	ends = sorted(tokto.keys())
+	tokpos = (begins, [tokfrom[p] for p in begins], ends, [tokto[p] for p in ends])
+	start = time.perf_counter()
+	snapped = [readback_cas.snap_span(begin, end, tokpos) for begin, end in spans]
+	snaptime = time.perf_counter() - start
+	if snapped != stepped:
+		print("WARNING: bisect snapping differs from character stepping")
+	print("snapping, character stepping: %8.3f s" % steptime)
+	print("snapping, bisect:             %8.3f s" % snaptime)
+
+	# The full readback
+	readback_cas.cargs = {"infile": xmifile}
+	if args.types:
+		readback_cas.cargs["types"] = args.types
+	start = time.perf_counter()
+	readback_cas.readback(xmlfile)
+	print("full readback:                %8.3f s" % (time.perf_counter() - start))
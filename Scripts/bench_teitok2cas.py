@@ -0,0 +1,54 @@
+import argparse
+import os, tempfile, time
+import teitok2cas
+
+# Benchmark for teitok2cas.py: convert generated spoken-style documents, where all sentences
+# are stand-off <s sameAs="..."/>, at growing sizes; the time per token should stay about the
+# same (the @sameAs references are resolved through an id index, not a tree scan per token)
+
+parser = argparse.ArgumentParser(description="Benchmark teitok2cas.py on generated documents with @sameAs sentences")
+parser.add_argument("--types", help="TypeSystem filename (default: as for teitok2cas.py)", type=str)
+parser.add_argument("--sizes", help="comma separated document sizes in tokens", type=str, default="10000,20000,40000,80000")
+parser.add_argument("--stream", help="use the --stream mode of teitok2cas.py", action="store_true")
+args = parser.parse_args()
+
+def make_document(filename, ntoks, sentlen=12):
+	# Tokens in <u> elements, with the sentences referring to them by @sameAs
+	with open(filename, "w") as f:
+		f.write("<TEI><teiHeader/><text>\n")
+		for first in range(1, ntoks+1, sentlen):
+			last = min(first + sentlen, ntoks + 1)
+			f.write("<u>" + " ".join('<tok id="w-%d" upos="X" lemma="w%d">w%d</tok>' % (i, i, i) for i in range(first, last)) + "</u>\n")
+		for first in range(1, ntoks+1, sentlen):
+			last = min(first + sentlen, ntoks + 1)
+			f.write('<s id="s-%d" sameAs="%s"/>\n' % (first, " ".join("#w-%d" % i for i in range(first, last))))
+		f.write("</text></TEI>\n")
+
+options = {}
+if args.types:
+	options["types"] = args.types
+if args.stream:
+	options["stream"] = 1
+teitok2cas.init_types(options)
+
+results = []
+with tempfile.TemporaryDirectory() as tmpdir:
+	for ntoks in [int(size) for size in args.sizes.split(",")]:
+		filename = os.path.join(tmpdir, "bench-" + str(ntoks) + ".xml")
+		make_document(filename, ntoks)
+		start = time.perf_counter()
+		if args.stream:
+			teitok2cas.convert_stream(filename)
+		else:
+			teitok2cas.convert(filename)
+		duration = time.perf_counter() - start
+		results.append((ntoks, duration))
+		print("%8d tokens: %8.3f s  %6.2f us/token" % (ntoks, duration, 1e6 * duration / ntoks))
+
+# With linear scaling the time per token stays about the same across sizes
+if len(results) > 1:
+	first = results[0][1] / results[0][0]
+	last = results[-1][1] / results[-1][0]
+	print("time per token, largest vs smallest document: %.2fx" % (last / first))
+	if last > 2 * first:
+		print("WARNING: conversion time grows faster than linearly")
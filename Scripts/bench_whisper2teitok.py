@@ -0,0 +1,70 @@
+import argparse
+import random, string, sys, time
+import lxml.etree as etree
+
+# Micro-benchmark for whisper2teitok.py: convert a generated, heavily punctuated segment into
+# a <u> with segment2u, and compare with the previous splitting of punctuation marks, which
+# looked up the position of the token in the utterance for every punctuation mark
+
+parser = argparse.ArgumentParser(description="Benchmark the conversion of a long Whisper segment into a <u>")
+parser.add_argument("--sizes", help="comma separated segment sizes in words", type=str, default="2500,5000,10000")
+parser.add_argument("--previous-max", help="largest segment to also time the (quadratic) previous version on", type=int, default=5000)
+args = parser.parse_args()
+
+# whisper2teitok.py reads its options when it is imported
+sys.argv = [sys.argv[0], "bench.wav"]
+import whisper2teitok
+
+def make_segment(nwords):
+	# Words with one to three trailing punctuation marks on most of them
+	random.seed(1)
+	words = []
+	for i in range(nwords):
+		text = "w" + str(i) + "".join(random.choice(",.?!") for k in range(random.choice([0, 1, 1, 2, 3])))
+		words.append({'text': text, 'start': i * 0.3, 'end': i * 0.3 + 0.25})
+	return {'text': " " + " ".join(word['text'] for word in words), 'start': 0.0, 'end': nwords * 0.3, 'words': words}
+
+def old_segment2u(seg):
+	# The previous version of the token loop
+	utt = etree.Element("u")
+	tokcnt = 0
+	for word in seg['words']:
+		tok = etree.Element("tok")
+		utt.append(tok)
+		tok.text = word['text']
+		tok.set("start", str(word['start']))
+		tok.set("end", str(word['end']))
+		tokcnt = tokcnt + 1
+		tok.set("id", "w-"+str(tokcnt))
+		tok.tail = " "
+		last = True
+		while tok.text[-1] in string.punctuation:
+			old = tok.text
+			punct = etree.Element("tok")
+			punct.text = old[-1]
+			tokcnt = tokcnt + 1
+			punct.set("id", "w-"+str(tokcnt))
+			index = list(utt).index(tok)
+			utt.insert(index+1, punct)
+			tok.text = old[0:-1]
+			if last:
+				punct.tail = " "
+				tok.tail = ""
+			last = False
+	return utt
+
+def timed(function):
+	start = time.perf_counter()
+	result = function()
+	return result, time.perf_counter() - start
+
+for nwords in [int(size) for size in args.sizes.split(",")]:
+	seg = make_segment(nwords)
+	utt, newtime = timed(lambda: whisper2teitok.segment2u(seg, {'utt': 0, 'tok': 0}))
+	line = "%6d words, %6d tokens: segment2u %7.3f s" % (nwords, len(utt), newtime)
+	if nwords <= args.previous_max:
+		oldutt, oldtime = timed(lambda: old_segment2u(seg))
+		line = line + ", previous version %7.3f s" % oldtime
+		if [tok.text for tok in utt] != [tok.text for tok in oldutt]:
+			line = line + " (WARNING: different tokens)"
+	print(line)
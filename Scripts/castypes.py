@@ -0,0 +1,95 @@
+from cassis import load_typesystem
+from importlib.metadata import version
+import hashlib, pickle
+import os
+try:
+	# The TypeSystem types are classes generated at load time, which the standard pickle
+	# cannot serialize; cloudpickle stores them by value. Without it there is no disk cache.
+	import cloudpickle
+except ImportError:
+	cloudpickle = None
+
+# Shared TypeSystem loader for the scripts that convert between TEITOK/XML and UIMA CAS
+#
+# The TypeSystem is taken from (in that order): an explicit filename (--types), the
+# TEITOK_TYPESYSTEM environment variable, inception_typesystem.xml next to these scripts,
+# or the legacy default location. Parsing the (large) INCEpTION TypeSystem is slow, so the
+# loaded TypeSystem is kept in memory per process, and pickled on disk keyed by the hash
+# of the XML file (and the cassis version), so that later runs can skip the XML parsing
+# (the disk cache requires cloudpickle).
+
+legacy_typefile = "/Users/mjanssen/Git/dkpro-cassis/tests/test_files/typesystems/inception_typesystem.xml"
+
+typesystems = {}
+
+def resolve_typesystem(typefile=None):
+	# Find the TypeSystem XML file to use
+	if typefile:
+		return typefile
+	if os.environ.get("TEITOK_TYPESYSTEM"):
+		return os.environ["TEITOK_TYPESYSTEM"]
+	bundled = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inception_typesystem.xml")
+	if os.path.exists(bundled):
+		return bundled
+	return legacy_typefile
+
+def cache_folder():
+	# Folder for the pickled TypeSystems: TEITOK_TYPECACHE, or ~/.cache/teitok
+	folder = os.environ.get("TEITOK_TYPECACHE")
+	if not folder:
+		folder = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "teitok")
+	return folder
+
+def file_hash(filename):
+	sha = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b""):
+			sha.update(chunk)
+	sha.update(version("dkpro-cassis").encode())
+	sha.update(version("cloudpickle").encode())
+	return sha.hexdigest()
+
+def get_typesystem(typefile=None, verbose=False):
+	# Load the TypeSystem, from memory, from the pickle cache, or from the XML file
+	typefile = os.path.abspath(resolve_typesystem(typefile))
+	if typefile in typesystems:
+		return typesystems[typefile]
+	if verbose:
+		print("Using TypeSystem from file: " + typefile)
+
+	cachefile = None
+	if cloudpickle is not None:
+		cachefile = os.path.join(cache_folder(), "typesystem-" + file_hash(typefile) + ".pickle")
+	elif verbose:
+		print("Install cloudpickle to cache the TypeSystem on disk")
+	typesystem = None
+	if cachefile and os.path.exists(cachefile):
+		try:
+			with open(cachefile, 'rb') as f:
+				typesystem = pickle.load(f)
+		except Exception as e:
+			if verbose:
+				print("Ignoring unreadable TypeSystem cache " + cachefile + ": " + str(e))
+
+	if typesystem is None:
+		with open(typefile, 'rb') as f:
+			typesystem = load_typesystem(f)
+		if cachefile:
+			store_typesystem(typesystem, cachefile)
+
+	typesystems[typefile] = typesystem
+	return typesystem
+
+def store_typesystem(typesystem, cachefile):
+	# Write the pickle to a temporary file first, so that a concurrent run never reads a half-written one
+	tmpfile = cachefile + "." + str(os.getpid()) + ".tmp"
+	try:
+		os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+		with open(tmpfile, 'wb') as f:
+			cloudpickle.dump(typesystem, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmpfile, cachefile)
+	except Exception as e:
+		# Caching is only an optimization: carry on without it, but do say why
+		if os.path.exists(tmpfile):
+			os.remove(tmpfile)
+		print("Could not cache the TypeSystem: " + str(e))
@@ -0,0 +1,79 @@
+# Streaming CoNLL-U reader: yields one sentence at a time, so that even very
+# large files can be processed with bounded memory
+
+class ConlluWord:
+	# A single CoNLL-U line (word, multiword token, or empty node); MISC is only parsed on demand
+	__slots__ = ('cols', '_misc')
+
+	def __init__(self, cols):
+		self.cols = cols
+		self._misc = None
+
+	@property
+	def ord(self):
+		return self.cols[0]
+
+	@property
+	def form(self):
+		return self.cols[1]
+
+	@property
+	def kind(self):
+		# word (1), multiword token (1-2) or empty node (1.1)
+		if "-" in self.cols[0]:
+			return "multi"
+		if "." in self.cols[0]:
+			return "empty"
+		return "word"
+
+	@property
+	def misc(self):
+		# List of (key, value) pairs; value is None for fields without a =
+		if self._misc is None:
+			self._misc = []
+			if len(self.cols) > 9 and self.cols[9] != "_":
+				for mf in self.cols[9].split("|"):
+					mfa = mf.split("=", 1)
+					if len(mfa) == 1:
+						self._misc.append((mf, None))
+					else:
+						self._misc.append((mfa[0], mfa[1]))
+		return self._misc
+
+class ConlluSentence:
+	# The comment lines and the nodes of a single sentence, in file order
+	__slots__ = ('comments', 'words')
+
+	def __init__(self, comments, words):
+		self.comments = comments
+		self.words = words
+
+	def meta(self):
+		# The "# key = value" comments as a dict (newdoc, sent_id, text, ...)
+		meta = {}
+		for comment in self.comments:
+			tmp = comment[1:].split("=", 1)
+			key = tmp[0].strip()
+			if len(tmp) == 1:
+				meta[key] = ""
+			else:
+				meta[key] = tmp[1].strip()
+		return meta
+
+def read_sentences(fh):
+	# Generator over the sentences in an open CoNLL-U file
+	comments = []
+	words = []
+	for line in fh:
+		data = line.rstrip("\r\n")
+		if data == "":
+			if words or comments:
+				yield ConlluSentence(comments, words)
+			comments = []
+			words = []
+		elif data[0:1] == "#":
+			comments.append(data)
+		else:
+			words.append(ConlluWord(data.split("\t")))
+	if words or comments:
+		yield ConlluSentence(comments, words)
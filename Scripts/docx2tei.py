@@ -1,66 +1,26 @@
 import sys
 import os
 import base64
+import hashlib
+import shutil
+import traceback
 import argparse
 from docx import Document
 from docx.opc.exceptions import PackageNotFoundError
 from docx.oxml import parse_xml
 from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+from docx.table import Table
 from lxml import etree
 from datetime import date
 import zipfile
 from pathlib import Path
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 
 # TODO: 
 # - page breaks
 
-def extract_images_and_map_relationships(docx_path):
-    """
-    Extract images from a DocX file and map relationship IDs to image filenames.
-    """
-
-    # Open the DocX file as a ZIP archive
-    with zipfile.ZipFile(docx_path) as docx_zip:
-        # Extract all files in the 'word/media' directory
-        image_files = [f for f in docx_zip.namelist() if f.startswith("word/media/")]
-
-        # Save images and map their relationship IDs
-        for idx, image_file in enumerate(image_files):
-            # Get the image filename and extension
-            image_filename = os.path.basename(image_file)
-
-            # Save the image to the output directory
-            output_path = os.path.join(image_dir, image_filename)
-
-            if not os.path.exists(image_dir):
-                os.makedirs(image_dir)
-
-            with docx_zip.open(image_file) as image_data:
-                with open(output_path, "wb") as img_file:
-                    img_file.write(image_data.read())
-
-            # Map the relationship ID to the saved image filename
-            relationship_id = os.path.splitext(image_filename)[0]
-            image_map[relationship_id] = image_filename
-
-        # Parse the document relationships to map relationship IDs to image paths
-        rels_path = "word/_rels/document.xml.rels"
-        if rels_path in docx_zip.namelist():
-            with docx_zip.open(rels_path) as rels_file:
-                rels_xml = rels_file.read()
-                rels_root = etree.fromstring(rels_xml)
-
-                for rel in rels_root.findall(".//{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"):
-                    if "image" in rel.get("Type"):
-                        relationship_id = rel.get("Id")
-                        target = rel.get("Target")
-                        if target.startswith("media/"):
-                            image_filename = os.path.basename(target)
-                            image_map[relationship_id] = image_filename
-
-    return image_map
-
 def get_color(run):
     """Extract font color from the run."""
     if run.font.color and run.font.color.rgb:
@@ -167,342 +127,583 @@ def get_tag(element):
         tagname = tagname.replace("{"+nst+"}", "")
     return tagname
 
-def process_run(run):
-    """Convert a run (styled text) to TEI <hi> with a single style attribute."""
-    text_elem = etree.Element("hi")
-
-    # Collect all styles
-    styles = get_color(run) + get_font_size(run) + get_text_styles(run)
-    if styles:
-        text_elem.set("style", styles.strip())
-
-    xml_str = run._element.xml
-    if "w:footnoteReference" in xml_str:
-        # Extract footnote ID
-        run_xml = etree.fromstring(xml_str)
-        for footnote_ref in run_xml.findall(".//w:footnoteReference", namespaces):
-            footnote_id = footnote_ref.get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}id")
-            if footnote_id in footnote_map:
-                # create a <note> with the text inside for the footnote
-                text_elem = etree.Element("note")
-                text_elem.set("id", "fn-" + str(footnote_id))
-                text_elem.text = footnote_map.get(footnote_id)
+def flush_text(dst, textbuf):
+    """ Add the buffered text at the end of `dst` (as text or as the tail of its last child). """
+    text = "".join(textbuf)
+    textbuf.clear()
+    if not text:
+        return
+    if len(dst) > 0:
+        dst[-1].tail = (dst[-1].tail or "") + text
     else:
-        text_elem.text = run.text
+        dst.text = (dst.text or "") + text
 
-    return text_elem
+def append_mixed_content(src, dst, textbuf):
+    """ Move all children and text content from `src` to `dst` in the correct order.
 
-def append_mixed_content(src, dst):
-    """ Append all children and text content from `src` to `dst` in the correct order. """
-
-    # Find the last node in the destination (last child OR text)
-    last_child = dst[-1] if len(dst) > 0 else None
+    Text is collected in `textbuf` (which belongs to `dst`), and only joined when an element
+    is moved or the buffer is flushed, to avoid repeated string concatenation.
+    """
+    textbuf.append(src.text or "")
+
+    # Move each child while preserving order (the tail moves along with it)
+    for child in list(src):
+        flush_text(dst, textbuf)
+        dst.append(child)
+
+CHUNK_SIZE = 1024 * 1024
+
+def stream_hash(fileobj):
+    """SHA-1 of a file object, read in chunks."""
+    sha = hashlib.sha1()
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+class ImageIndex:
+    """Content hashes of the images below a folder; files are only hashed when an image of the same size comes along."""
+
+    def __init__(self, root):
+        self.by_size = {}
+        self.hashes = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                self.by_size.setdefault(os.path.getsize(path), []).append(path)
+
+    def hash_of(self, path):
+        if path not in self.hashes:
+            with open(path, "rb") as f:
+                self.hashes[path] = stream_hash(f)
+        return self.hashes[path]
+
+    def find(self, digest, size):
+        for path in self.by_size.get(size, []):
+            if self.hash_of(path) == digest:
+                return path
+        return None
 
-    # If there's existing text and no elements, append to the text
-    if last_child is None:
-        dst.text = (dst.text or "") + (src.text or "")
-    else:
-        # If there's already an element, append new text to its tail
-        last_child.tail = (last_child.tail or "") + (src.text or "")
+    def add(self, path, digest, size):
+        for paths in self.by_size.values():
+            if path in paths:
+                paths.remove(path)
+        self.by_size.setdefault(size, []).append(path)
+        self.hashes[path] = digest
+
+image_indexes = {}
+
+def get_image_index(root):
+    """One ImageIndex per Graphics folder (per process)."""
+    key = os.path.abspath(root)
+    if key not in image_indexes:
+        image_indexes[key] = ImageIndex(root)
+    return image_indexes[key]
+
+class DocxError(ValueError):
+    """The DOCX file is missing or cannot be read."""
+
+class DocxConverter:
+    """Convert a single DOCX file to TEI; holds all the state for that one document."""
+
+    def __init__(self, docx_file, output_tei_file, image_dir, orgfile=""):
+        self.docx_file = docx_file
+        self.output_tei_file = output_tei_file
+        self.image_dir = image_dir
+        self.orgfile = orgfile or docx_file
+
+        # Determine what to put as the link for images: relative to Graphics/ in a TEITOK project
+        path = Path(image_dir)
+        if path.parts[1:] and path.parts[-2] == "Graphics":
+            self.graphics_root = str(path.parent)
+            self.graphics_url = ""
+        else:
+            self.graphics_root = image_dir
+            self.graphics_url = image_dir
+
+        # The image, footnote, and hyperlink references of the document
+        self.image_map = {}
+        self.footnote_map = {}
+        self.hyperlink_map = {}
+        self.style_cache = {}
+
+    def extract_images_and_map_relationships(self, docx_path, doc):
+        """
+        Extract the images referenced in the document body and map their relationship IDs to image URLs.
+        Images are streamed out of the DocX, and not written again when the same content is already
+        present in the Graphics folder.
+        """
+
+        # Collect the relationship IDs of the images used in the body
+        referenced = set()
+        for blip in doc.element.body.iter(f"{{{namespaces['a']}}}blip"):
+            relationship_id = blip.get(f"{{{namespaces['r']}}}embed")
+            if relationship_id:
+                referenced.add(relationship_id)
+        if not referenced:
+            return self.image_map
+
+        # Open the DocX file as a ZIP archive
+        with zipfile.ZipFile(docx_path) as docx_zip:
+            members = set(docx_zip.namelist())
+
+            # Parse the document relationships to map relationship IDs to image paths
+            rels_path = "word/_rels/document.xml.rels"
+            if rels_path not in members:
+                return self.image_map
+            with docx_zip.open(rels_path) as rels_file:
+                rels_root = etree.parse(rels_file).getroot()
+
+            for rel in rels_root.findall(".//{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"):
+                relationship_id = rel.get("Id")
+                target = rel.get("Target")
+                if relationship_id in referenced and "image" in rel.get("Type") and target.startswith("media/"):
+                    image_file = "word/" + target
+                    if image_file in members:
+                        self.image_map[relationship_id] = self.store_image(docx_zip, image_file)
+
+        return self.image_map
+
+    def store_image(self, docx_zip, image_file):
+        """Save an image from the DocX unless its content is already in the Graphics folder; returns its URL."""
+        size = docx_zip.getinfo(image_file).file_size
+        with docx_zip.open(image_file) as image_data:
+            digest = stream_hash(image_data)
+
+        index = get_image_index(self.graphics_root)
+        output_path = os.path.join(self.image_dir, os.path.basename(image_file))
+        if os.path.exists(output_path) and os.path.getsize(output_path) == size and index.hash_of(output_path) == digest:
+            image_path = output_path
+        else:
+            image_path = index.find(digest, size)
+        if image_path is None:
+            # Save the image to the output directory, in chunks; existing files may be referenced
+            # by other (deduplicated) documents, so they are never overwritten: changed content
+            # gets a name prefixed with its hash instead
+            os.makedirs(self.image_dir, exist_ok=True)
+            try:
+                image_path = self.write_image(docx_zip, image_file, output_path)
+            except FileExistsError:
+                output_path = os.path.join(self.image_dir, digest[:12] + "-" + os.path.basename(image_file))
+                try:
+                    image_path = self.write_image(docx_zip, image_file, output_path)
+                except FileExistsError:
+                    # Already written (by a parallel conversion): same hash, so the same content
+                    image_path = output_path
+            index.add(image_path, digest, size)
+
+        return os.path.join(self.graphics_url, os.path.relpath(image_path, self.graphics_root))
+
+    def write_image(self, docx_zip, image_file, output_path):
+        """Copy an image out of the DocX, in chunks; raises FileExistsError rather than overwriting."""
+        with docx_zip.open(image_file) as image_data:
+            with open(output_path, "xb") as img_file:
+                shutil.copyfileobj(image_data, img_file, CHUNK_SIZE)
+        return output_path
+
+    def run_styles(self, run):
+        """Get the CSS for a run, memoized on its style and its run properties."""
+        rpr = run._element.rPr
+        key = (run._element.style, etree.tostring(rpr) if rpr is not None else b"")
+        if key not in self.style_cache:
+            self.style_cache[key] = get_color(run) + get_font_size(run) + get_text_styles(run)
+        return self.style_cache[key]
+
+    def process_run(self, run):
+        """Convert a run (styled text) to TEI <hi> with a single style attribute."""
+        text_elem = etree.Element("hi")
+
+        # Collect all styles
+        styles = self.run_styles(run)
+        if styles:
+            text_elem.set("style", styles.strip())
+
+        footnote_refs = run._element.findall(".//w:footnoteReference", namespaces)
+        if footnote_refs:
+            # Extract footnote ID
+            for footnote_ref in footnote_refs:
+                footnote_id = footnote_ref.get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}id")
+                if footnote_id in self.footnote_map:
+                    # create a <note> with the text inside for the footnote
+                    text_elem = etree.Element("note")
+                    text_elem.set("id", "fn-" + str(footnote_id))
+                    text_elem.text = self.footnote_map.get(footnote_id)
+        else:
+            text_elem.text = run.text
 
-    # Append each child while preserving order
-    for child in src:
-        copied_child = copy.deepcopy(child)  # Copy child element
-        dst.append(copied_child)  # Append to destination
+        return text_elem
 
-        if child.tail:
-            copied_child.tail = child.tail  # Preserve tail text after each element
-            
-def process_paragraph(para):
-    """Convert a paragraph to TEI."""
+    def process_paragraph(self, para):
+        """Convert a paragraph to TEI."""
 
 
-    para_elem = etree.Element("p")
-    para_elem.tail = "\n"
+        para_elem = etree.Element("p")
+        para_elem.tail = "\n"
 
-    para_style = paragraph_to_css(para)
-    if para_style:
-        para_elem.set("style", para_style)
+        para_style = paragraph_to_css(para)
+        if para_style:
+            para_elem.set("style", para_style)
 
-    # Extract paragraph background color
-    background_color = get_background_color(para)
-    if background_color:
-        para_elem.set("style", background_color.strip())
+        # Extract paragraph background color
+        background_color = get_background_color(para)
+        if background_color:
+            para_elem.set("style", background_color.strip())
     
-    run_map = {}
-    for run in para.runs:
-        run_map[run._element] = run
+        run_map = {}
+        for run in para.runs:
+            run_map[run._element] = run
     
-    lasthi = para_elem
-    for child in para._element:
-        tagname = get_tag(child)
-        if tagname in [ "pPr", "proofErr", "bookmarkStart", "bookmarkEnd", "smartTag" ] : # things that can be ignored
-            pass
-        elif tagname == "hyperlink": # Hyperlinks
-            ns = '{' + namespaces['r'] + '}'
-            rId = child.get(f"{ns}id")
-            if rId in hyperlink_map:
-                url = hyperlink_map[rId]
-                ref_elem = etree.Element("ref")
-                ref_elem.set("target", url)
-                hyperlinktext = ""
-                for run_xml in child.findall(".//w:t", namespaces=namespaces):
-                    hyperlinktext = hyperlinktext + run_xml.text
-                ref_elem.text = hyperlinktext # This should parse a full run inside a <w:hyperlink> if it exists
-                para_elem.append(ref_elem)
-        elif tagname == "r": # Styled elements
-            r_id = child.getparent().get("r:id")
-            hi = process_run(run_map[child])
-            if len(hi) > 0 or ( hi.text is not None and hi.text):
-                # Skip empty elements
-                if not hi.attrib: 
-                    # Add to the paragraph directly if there is no styling
-                    append_mixed_content(hi, para_elem)
+        lasthi = para_elem
+        textbuf = [] # text still to be added at the end of lasthi
+        for child in para._element:
+            tagname = get_tag(child)
+            if tagname in [ "pPr", "proofErr", "bookmarkStart", "bookmarkEnd", "smartTag" ] : # things that can be ignored
+                pass
+            elif tagname == "hyperlink": # Hyperlinks
+                ns = '{' + namespaces['r'] + '}'
+                rId = child.get(f"{ns}id")
+                if rId in self.hyperlink_map:
+                    url = self.hyperlink_map[rId]
+                    ref_elem = etree.Element("ref")
+                    ref_elem.set("target", url)
+                    hyperlinktext = ""
+                    for run_xml in child.findall(".//w:t", namespaces=namespaces):
+                        hyperlinktext = hyperlinktext + run_xml.text
+                    ref_elem.text = hyperlinktext # This should parse a full run inside a <w:hyperlink> if it exists
+                    flush_text(lasthi, textbuf)
+                    para_elem.append(ref_elem)
                     lasthi = para_elem
-                elif hi.get("style") == lasthi.get("style"):
-                    # Add to the last hi if styling has not changed
-                    append_mixed_content(hi, lasthi)
+            elif tagname == "r": # Styled elements
+                r_id = child.getparent().get("r:id")
+                hi = self.process_run(run_map[child])
+                if len(hi) > 0 or ( hi.text is not None and hi.text):
+                    # Skip empty elements
+                    if not hi.attrib: 
+                        # Add to the paragraph directly if there is no styling
+                        if lasthi is not para_elem:
+                            flush_text(lasthi, textbuf)
+                            lasthi = para_elem
+                        append_mixed_content(hi, para_elem, textbuf)
+                    elif hi.get("style") == lasthi.get("style"):
+                        # Add to the last hi if styling has not changed
+                        append_mixed_content(hi, lasthi, textbuf)
+                    else:
+                        # Add the new hi element
+                        flush_text(lasthi, textbuf)
+                        para_elem.append(hi)
+                        lasthi = hi      
+            else:
+                print("Unhandled paragraph child: ", tagname)          
+
+            # Handle images
+            for drawing in child.findall(".//w:drawing", namespaces=namespaces):
+                blip = drawing.find(".//a:blip", namespaces=namespaces)
+                if blip is not None:
+                    relationship_id = blip.get("{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed")
+                    if relationship_id:
+                        # Find the corresponding image filename
+                        image_url = self.image_map.get(relationship_id)
+                        if image_url:
+                            # Add a <figure> and <graphic> element to the TEI
+                            flush_text(lasthi, textbuf)
+                            lasthi = para_elem
+                            figure = etree.SubElement(para_elem, "figure")
+                            figure.set("id", relationship_id)
+                            graphic = etree.SubElement(figure, "graphic", url=image_url)
+    
+        flush_text(lasthi, textbuf)
+
+        # Skip the paragraph if it is empty
+        if len(para_elem) == 0 and not para_elem.text:
+            return None
+
+        return para_elem
+
+    def process_table(self, table):
+        """Convert a DOCX table to TEI.
+
+        Walks the w:tr/w:tc elements directly instead of python-docx's row.cells (which rebuilds the
+        grid for every row, and repeats merged cells); merged cells become @cols and @rows.
+        """
+        table_elem = etree.Element("table")
+        w = "{" + namespaces["w"] + "}"
+        vmerged = {} # grid column => the <cell> a vertical merge started in
+
+        for tr in table._element.iterchildren(w + "tr"):
+            row_elem = etree.Element("row")
+            gridcol = 0
+            gridbefore = tr.find("w:trPr/w:gridBefore", namespaces)
+            if gridbefore is not None:
+                gridcol = int(gridbefore.get(w + "val", "0"))
+            for tc in tr.iterchildren(w + "tc"):
+                span = 1
+                gridspan = tc.find("w:tcPr/w:gridSpan", namespaces)
+                if gridspan is not None:
+                    span = int(gridspan.get(w + "val", "1"))
+                vmerge = tc.find("w:tcPr/w:vMerge", namespaces)
+                if vmerge is not None and vmerge.get(w + "val", "continue") == "continue" and gridcol in vmerged:
+                    # Continuation of a vertically merged cell
+                    start_elem = vmerged[gridcol]
+                    start_elem.set("rows", str(int(start_elem.get("rows", "1")) + 1))
+                    gridcol = gridcol + span
+                    continue
+
+                cell_elem = etree.Element("cell")
+                if span > 1:
+                    cell_elem.set("cols", str(span))
+                if vmerge is not None:
+                    vmerged[gridcol] = cell_elem
                 else:
-                    # Add the new hi element
-                    para_elem.append(hi)
-                    lasthi = hi      
-        else:
-            print("Unhandled paragraph child: ", tagname)          
-
-        # Handle images
-        for drawing in child.findall(".//w:drawing", namespaces=namespaces):
-            blip = drawing.find(".//a:blip", namespaces=namespaces)
-            if blip is not None:
-                relationship_id = blip.get("{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed")
-                if relationship_id:
-                    # Find the corresponding image filename
-                    image_filename = image_map.get(relationship_id)
-                    if image_filename:
-                        # Add a <figure> and <graphic> element to the TEI
-                        figure = etree.SubElement(para_elem, "figure")
-                        figure.set("id", relationship_id)
-                        graphic = etree.SubElement(figure, "graphic", url=os.path.join(image_reldir, image_filename))
+                    vmerged.pop(gridcol, None)
+                for p in tc.iterchildren(w + "p"):
+                    processed_para = self.process_paragraph(Paragraph(p, table))
+                    if processed_para is not None:  # Explicit check
+                        cell_elem.append(processed_para)
+                row_elem.append(cell_elem)
+                gridcol = gridcol + span
+            table_elem.append(row_elem)
+
+        return table_elem
+
+    def extract_relationships(self, doc):
+        """Go through the relationships of the main document part once: hyperlinks and the footnotes part."""
+        footnotes_part = None
+        for rId, rel in doc.part.rels.items():
+            self.hyperlink_map[rId] = rel.target_ref
+            if footnotes_part is None and not rel.is_external and "footnotes" in rel.target_ref:
+                footnotes_part = rel.target_part
+        return footnotes_part
+
+    def extract_footnotes(self, footnotes_part):
+        """Extract footnotes manually from docx XML."""
+        footnotes_elem = etree.Element("notes")
+ 
+        if not footnotes_part:
+            return
+
+        fncnt = 1
+        footnotes_xml = etree.parse(BytesIO(footnotes_part.blob))
+        ns = {"w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"}
+        for footnote in footnotes_xml.findall("w:footnote", ns):
+            footnote_id = footnote.get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}id")
+            fntext = "".join(node.text or "" for node in footnote.findall(".//w:t", ns))
+            note_elem = etree.Element("note")
+            note_elem.text = fntext
+            footnote_id = footnote.get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}id")
+            note_elem.set("id", "fn-" + footnote_id)
+            fncnt = fncnt + 1
+            footnotes_elem.append(note_elem)
+            self.footnote_map[footnote_id] = fntext
+
+        # Skip the paragraph if it is empty
+        if len(footnotes_elem) == 0 and not footnotes_elem.text:
+            return None
+
+        return footnotes_elem
+
+    def convert(self):
+        """Convert the DOCX file and write the TEI file."""
+        docx_file = self.docx_file
+        output_tei_file = self.output_tei_file
+
+        try:
+            # Attempt to open the .docx file
+            doc = Document(docx_file)
+        except PackageNotFoundError:
+            raise DocxError(f"The file '{docx_file}' is not a valid .docx file or is corrupted.")
+        except FileNotFoundError:
+            raise DocxError(f"The file '{docx_file}' does not exist.")
+
+        self.image_map = self.extract_images_and_map_relationships(docx_file, doc)
+        footnotes = self.extract_footnotes(self.extract_relationships(doc))
+
+        XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+        # Create the TEI header (the text is written element by element below)
+        tei_header = etree.Element("teiHeader")
+
+        filedesc = etree.SubElement(tei_header, "fileDesc")
+        notesstmt = etree.SubElement(filedesc, "notesStmt")
+        note = etree.SubElement(notesstmt, "note")
+        note.set("n", "orgfile")
+        note.text = self.orgfile
+        revisiondesc = etree.SubElement(tei_header, "revisionDesc")
+        change = etree.SubElement(revisiondesc, "change")
+        change.set("who", "docx2tei")
+        today = str(date.today())
+        change.set("when", today)
+        change.text = "Converted from DOCX file " + docx_file
+        titlestmt = etree.SubElement(filedesc, "titleStmt")
+        profiledesc = etree.SubElement(tei_header, "profileDesc")
     
-    # Skip the paragraph if it is empty
-    if len(para_elem) == 0 and not para_elem.text:
-        return None
-
-    return para_elem
+        # Handle the document metadata
+        metadata = doc.core_properties
+        if doc.core_properties.title:
+            title = etree.SubElement(titlestmt, "title")
+            title.text = doc.core_properties.title
+        if doc.core_properties.author:
+            author = etree.SubElement(titlestmt, "author")
+            author.text = doc.core_properties.author
+        if doc.core_properties.created:
+            cdate = etree.SubElement(titlestmt, "date")
+            cdate.text = str(doc.core_properties.created)
+        if doc.core_properties.keywords:
+            textclass = etree.SubElement(profiledesc, "textClass")
+            keywords = etree.SubElement(textclass, "keywords")
+            term = etree.SubElement(keywords, "term")
+            term.text = doc.core_properties.keywords
+        if doc.core_properties.language:
+            langusage = etree.SubElement(profiledesc, "langUsage")
+            language = etree.SubElement(langusage, "language")
+            language.text = doc.core_properties.language
+
+
+        # Write the TEI XML, converting the body one element at a time
+        w = "{" + namespaces["w"] + "}"
+        etree.indent(tei_header, space="  ", level=1)
+        tei_header.tail = "\n  "
+        # Write to a temporary file first, so that a failed conversion does not leave a half-written file
+        tmpfile = output_tei_file + ".tmp"
+        with etree.xmlfile(tmpfile, encoding="UTF-8") as xf:
+            xf.write_declaration()
+            with xf.element("TEI"):
+                xf.write("\n  ")
+                xf.write(tei_header)
+                textatts = {f"{{{XML_NS}}}space": "preserve", "id": os.path.splitext(os.path.basename(docx_file))[0]}
+                # Declare the xml prefix explicitly, or xmlfile maps xml:space onto a made-up prefix
+                with xf.element("text", textatts, nsmap={"xml": XML_NS}):
+                    xf.write("\n    ")
+                    with xf.element("body"):
+                        # Iterate through the document body in order, wrapping the elements on demand
+                        for element in doc.element.body.iterchildren():
+                            processed_element = None
+                            if element.tag == w + "p":  # Paragraph
+                                processed_element = self.process_paragraph(Paragraph(element, doc._body))
+                            elif element.tag == w + "tbl":  # Table
+                                processed_element = self.process_table(Table(element, doc._body))
+                            elif element.tag == w + "sectPr":
+                                # Section Properties - skip
+                                pass
+                            else:
+                                print("Unknown: ", element.tag)
+
+                            if processed_element is not None:  # Explicit check
+                                xf.write(processed_element)
+
+                    # Place footnotes (endnotes) - make it optional!
+                    # if footnotes is not None:
+                    #     xf.write(footnotes)
+                    xf.write("\n  ")
+                xf.write("\n")
+        os.replace(tmpfile, output_tei_file)
+
+        print(f"Conversion complete! Saved as {output_tei_file}")
+
+def default_filenames(docx_filename, tei_filename="", image_dir=""):
+    """Determine default TEITOK style filenames (Originals -> xmlfiles, Graphics) or default to generic names."""
+    fileid = os.path.splitext(os.path.basename(docx_filename))[0]
+    if not tei_filename:
+        index = docx_filename.find("Originals")
+        if index != -1:
+            tei_filename = docx_filename[:index] + "xmlfiles/" + fileid + ".xml"
+        else:
+            tei_filename = os.path.splitext(docx_filename)[0] + ".xml"
 
-def process_table(table):
-    """Convert a DOCX table to TEI."""
-    table_elem = etree.Element("table")
-    
-    for row in table.rows:
-        row_elem = etree.Element("row")
-        for cell in row.cells:
-            cell_elem = etree.Element("cell")
-            for para in cell.paragraphs:
-                processed_para = process_paragraph(para)
-                if processed_para is not None:  # Explicit check
-                    cell_elem.append(processed_para)
-            row_elem.append(cell_elem)
-        table_elem.append(row_elem)
-
-    return table_elem
-
-def extract_hyperlinks(doc):
-    for rId in doc.part.rels:
-        rel = doc.part.rels[rId]
-        if hasattr(rel, "target_ref"):
-            hyperlink_map[rId] = rel.target_ref
-
-def extract_footnotes(doc):
-    """Extract footnotes manually from docx XML."""
-    footnotes_elem = etree.Element("notes")
- 
-    footnotes_part = None
-    for rel in doc.part.rels.values():
-        if "footnotes" in rel.target_ref:
-            footnotes_part = rel.target_part
-            break
-            
-    if not footnotes_part:
-        return
+    xmlid = os.path.splitext(os.path.basename(tei_filename))[0]
 
-    fncnt = 1
-    footnotes_xml = etree.parse(BytesIO(footnotes_part.blob))
-    ns = {"w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"}
-    for footnote in footnotes_xml.findall("w:footnote", ns):
-        footnote_id = footnote.get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}id")
-        fntext = "".join(node.text or "" for node in footnote.findall(".//w:t", ns))
-        note_elem = etree.Element("note")
-        note_elem.text = fntext
-        footnote_id = footnote.get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}id")
-        note_elem.set("id", "fn-" + footnote_id)
-        fncnt = fncnt + 1
-        footnotes_elem.append(note_elem)
-        footnote_map[footnote_id] = fntext
-
-    # Skip the paragraph if it is empty
-    if len(footnotes_elem) == 0 and not footnotes_elem.text:
-        return None
-
-    return footnotes_elem
+    if not image_dir:
+        index = tei_filename.find("xmlfiles")
+        if index != -1:
+            image_dir = tei_filename[:index] + "Graphics/" + xmlid
+        else:
+            image_dir = os.path.splitext(tei_filename)[0] + "_files"
 
-def convert_docx_to_tei(docx_file, output_tei_file):
+    return tei_filename, image_dir
 
+def convert_file(docx_filename, force=False):
+    """Convert a single file in folder mode; returns a status message and whether the conversion failed."""
+    tei_filename, image_dir = default_filenames(docx_filename)
+    if not force and os.path.exists(tei_filename) and os.path.getmtime(tei_filename) > os.path.getmtime(docx_filename):
+        return f"Skipped {docx_filename}: {tei_filename} is up to date", False
+    os.makedirs(os.path.dirname(tei_filename) or ".", exist_ok=True)
     try:
-        # Attempt to open the .docx file
-        doc = Document(docx_file)
-    except PackageNotFoundError:
-        print(f"Error: The file '{docx_file}' is not a valid .docx file or is corrupted.")
-        sys.exit(1)
-    except FileNotFoundError:
-        print(f"Error: The file '{docx_file}' does not exist.")
-        sys.exit(1)
+        DocxConverter(docx_filename, tei_filename, image_dir).convert()
+    except DocxError as e:
+        return f"Error: {docx_filename}: {e}", True
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        sys.exit(1)
-
-    image_map = extract_images_and_map_relationships(docx_file)
-    footnotes = extract_footnotes(doc)
-    hyperlinks = extract_hyperlinks(doc)
-
-    XML_NS = "http://www.w3.org/XML/1998/namespace"
-
-    # Create TEI structure
-    tei = etree.Element("TEI")
-    tei_header = etree.SubElement(tei, "teiHeader")
-    text = etree.SubElement(tei, "text")
-    text.set(f"{{{XML_NS}}}space", "preserve")
-    text.set("id", os.path.splitext(os.path.basename(docx_file))[0])
-    body = etree.SubElement(text, "body")
-
-
-    filedesc = etree.SubElement(tei_header, "fileDesc")
-    notesstmt = etree.SubElement(filedesc, "notesStmt")
-    note = etree.SubElement(notesstmt, "note")
-    note.set("n", "orgfile")
-    note.text = orgfile
-    revisiondesc = etree.SubElement(tei_header, "revisionDesc")
-    change = etree.SubElement(revisiondesc, "change")
-    change.set("who", "docx2tei")
-    today = str(date.today())
-    change.set("when", today)
-    change.text = "Converted from DOCX file " + docx_file
-    titlestmt = etree.SubElement(filedesc, "titleStmt")
-    profiledesc = etree.SubElement(tei_header, "profileDesc")
-    
-    # Handle the document metadata
-    metadata = doc.core_properties
-    if doc.core_properties.title:
-        title = etree.SubElement(titlestmt, "title")
-        title.text = doc.core_properties.title
-    if doc.core_properties.author:
-        author = etree.SubElement(titlestmt, "author")
-        author.text = doc.core_properties.author
-    if doc.core_properties.created:
-        cdate = etree.SubElement(titlestmt, "date")
-        cdate.text = str(doc.core_properties.created)
-    if doc.core_properties.keywords:
-        textclass = etree.SubElement(profiledesc, "textClass")
-        keywords = etree.SubElement(textclass, "keywords")
-        term = etree.SubElement(keywords, "term")
-        term.text = doc.core_properties.keywords
-    if doc.core_properties.language:
-        langusage = etree.SubElement(profiledesc, "langUsage")
-        language = etree.SubElement(langusage, "language")
-        language.text = doc.core_properties.language
-
-
-    # Map the docx elements onto a map
-    para_map = {}
-    for para in doc.paragraphs:
-        para_map[para._element] = para  # Map lxml element to python-docx paragraph
-    table_map = {}
-    for table in doc.tables:
-        table_map[table._element] = table  # Map lxml element to python-docx paragraph
-
-    # Iterate through the document body in order
-    for element in doc._element.findall(".//w:body/*", namespaces=namespaces):
-        if element.tag.endswith("p"):  # Paragraph
-            processed_element = process_paragraph(para_map.get(element))
-        elif element.tag.endswith("tbl"):  # Table
-            processed_element = process_table(table_map.get(element))
-        elif element.tag.endswith("sectPr"):  # Table
-            # Section Properties - skip
-            pass
-        else:
-            print("Unknown: ", element.tag)
-            
-        if processed_element is not None:  # Explicit check
-            body.append(processed_element)
-
-    # Place footnotes (endnotes) - make it optional!
-#     if footnotes is not None:
-#         text.append(footnotes)
-
-    # Save TEI XML
-    tree = etree.ElementTree(tei)
-    tree.write(output_tei_file, pretty_print=True, xml_declaration=True, encoding="utf-8")
+        # Anything else is a bug: show where it happened, but carry on with the other files
+        print(f"Error in {docx_filename}:\n{traceback.format_exc()}", file=sys.stderr)
+        return f"Error: {docx_filename}: {type(e).__name__}: {e}", True
+    return f"Converted {docx_filename} to {tei_filename}", False
+
+def convert_folder(folder, jobs=1, force=False):
+    """Convert all DOCX files in a folder (typically Originals/) to TEI (in xmlfiles/); returns the number of failed files."""
+    docx_files = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(".docx") and not name.startswith("~$"):
+                docx_files.append(os.path.join(root, name))
+
+    # The output is flat (xmlfiles/<name>.xml, Graphics/<name>), so files from different
+    # subfolders with the same name would overwrite each other
+    sources = {}
+    for docx_filename in docx_files:
+        tei_filename, image_dir = default_filenames(docx_filename)
+        if tei_filename in sources:
+            print(f"Both {sources[tei_filename]} and {docx_filename} would be written to {tei_filename}")
+            return len(docx_files)
+        sources[tei_filename] = docx_filename
+
+    failed = 0
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for message, error in pool.map(convert_file, docx_files, [force] * len(docx_files), chunksize=8):
+                print(message)
+                failed += error
+    else:
+        for docx_filename in docx_files:
+            message, error = convert_file(docx_filename, force)
+            print(message)
+            failed += error
+    if failed:
+        print(f"{failed} of {len(docx_files)} files failed")
+    return failed
 
-    print(f"Conversion complete! Saved as {output_tei_file}")
+namespaces = {
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+    "pic": "http://schemas.openxmlformats.org/drawingml/2006/picture",
+}
 
 parser = argparse.ArgumentParser(description="Convert a DOCX file to a (TEITOK style) TEI/XML file")
-parser.add_argument("file", help="DOCX file to convert")
+parser.add_argument("file", help="DOCX file to convert, or a folder of DOCX files")
 parser.add_argument("--force", help="force when output file exists", action="store_true")
 parser.add_argument("--debug", help="debug mode", action="store_true")
 parser.add_argument("-o", "--output", help="ouput TEI filename", type=str, default="")
 parser.add_argument("-i", "--image_dir", help="directory to store the images in", type=str, default="")
 parser.add_argument("--orgfile", help="original file that the DOCX was created from", type=str, default="")
-args = parser.parse_args()
-
+parser.add_argument("-j", "--jobs", help="number of parallel worker processes in folder mode", type=int, default=1)
 
-docx_filename = args.file
-fileid = os.path.splitext(os.path.basename(docx_filename))[0]
+if __name__ == "__main__":
+    args = parser.parse_args()
 
-# Command-line usage
-if not os.path.isfile(docx_filename):
-    print("No such file: ", docx_filename)
-    sys.exit(1)
+    docx_filename = args.file
 
-# Determine default TEITOK style filenames or default to generic names
-tei_filename = args.output
-if not tei_filename:
-    index = docx_filename.find("Originals")
-    if index != -1:
-        tei_filename = docx_filename[:index] + "xmlfiles/" + fileid + ".xml"
-        fileid = os.path.splitext(os.path.basename(docx_filename))[0]
-    else:
-        tei_filename = os.path.splitext(docx_filename)[0] + ".xml"
+    # Folder mode
+    if os.path.isdir(docx_filename):
+        failed = convert_folder(docx_filename, args.jobs, args.force)
+        sys.exit(1 if failed else 0)
 
-xmlid = os.path.splitext(os.path.basename(tei_filename))[0]
+    # Command-line usage
+    if not os.path.isfile(docx_filename):
+        print("No such file: ", docx_filename)
+        sys.exit(1)
 
-image_dir = args.image_dir 
-if not image_dir:
-    index = tei_filename.find("xmlfiles")
-    if index != -1:
-        image_dir = tei_filename[:index] + "Graphics/" + xmlid
-    else:
-        image_dir = os.path.splitext(tei_filename)[0] + "_files"
-
-orgfile = args.orgfile
-if not orgfile:
-    orgfile = docx_filename
-
-# Determine what to put as the link for images
-path = Path(image_dir)
-if path.parts[1:] and path.parts[-2] == "Graphics":
-    image_reldir = path.parts[-1]
-else:
-    image_reldir = image_dir
-    
-# Define global variables to hold the image and footnote references
-image_map = {}
-footnote_map = {}
-hyperlink_map  = {}
+    tei_filename, image_dir = default_filenames(docx_filename, args.output, args.image_dir)
 
-namespaces = {
-    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
-    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
-    "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
-    "pic": "http://schemas.openxmlformats.org/drawingml/2006/picture",
-}
-
-convert_docx_to_tei(docx_filename, tei_filename)
+    try:
+        DocxConverter(docx_filename, tei_filename, image_dir, args.orgfile).convert()
+    except DocxError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
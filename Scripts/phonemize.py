@@ -1,3 +1,5 @@
+import time
+starttime = time.perf_counter()
 from phonemizer.backend import EspeakBackend
 from phonemizer.punctuation import Punctuation
 from phonemizer.separator import Separator
@@ -5,85 +7,261 @@ from langcodes import *
 import argparse
 import lxml.etree as etree
 import sys, os, string
+from concurrent.futures import ProcessPoolExecutor
+import sqlite3
 
 parser = argparse.ArgumentParser(description="Provide each word in a TEITOK document with a phonetic transcription")
-parser.add_argument("file", help="TEITOK file to transcribe")
+parser.add_argument("file", help="TEITOK file to transcribe, or a folder to transcribe all XML files in")
 parser.add_argument("-l", "--lang", help="language of the file", type=str)
 parser.add_argument("--force", help="force when trancription exists", action="store_true")
 parser.add_argument("-s", "--sep", help="separator between phones", type=str, default=" ")
 parser.add_argument("-a", "--attr", help="attribute to your for transcription", type=str, default="phon")
 parser.add_argument("--languages", help="list supported languages", action="store_true")
+parser.add_argument("-j", "--jobs", help="number of parallel espeak jobs (worker processes in folder mode)", type=int, default=1)
+parser.add_argument("--cache", help="SQLite file to cache transcriptions across runs", type=str, nargs="?", const="phonemize.cache")
+parser.add_argument("--cache-size", help="maximum number of cached transcriptions", type=int, default=1000000)
+parser.add_argument("--profile-startup", help="print how long each step takes", action="store_true")
 args = parser.parse_args()
 
-# Get the list of supported languages
-supported_languages = EspeakBackend.supported_languages()
+# Timing of the steps for --profile-startup
+timings = []
+lasttime = starttime
+def checkpoint(label):
+	global lasttime
+	now = time.perf_counter()
+	timings.append((label, now - lasttime))
+	lasttime = now
 
-if args.languages:
-	print ("Supported languages:")
-	print (supported_languages)
-	exit()
-	
+checkpoint("imports")
 
-xmlf = etree.parse(args.file)
-# separate phones by a space and ignoring words boundaries
-separator = Separator(phone=args.sep, word=None)
+# In-run cache of transcriptions, keyed by (language, separator, form)
+memo = {}
 
+def cache_lookup(db, langid, forms):
+	# Fill the memo from the on-disk cache
+	for i in range(0, len(forms), 500):
+		chunk = forms[i:i+500]
+		query = "SELECT form, phon FROM phon WHERE lang = ? AND sep = ? AND form IN (" + ",".join("?" * len(chunk)) + ")"
+		for form, phon in db.execute(query, [langid, args.sep] + chunk):
+			memo[(langid, args.sep, form)] = phon
 
+def cache_store(db, langid, forms):
+	# Write the transcriptions back to the on-disk cache, and evict the least recently used ones
+	now = time.time()
+	db.executemany("INSERT OR REPLACE INTO phon VALUES (?, ?, ?, ?, ?)", [(langid, args.sep, form, memo[(langid, args.sep, form)], now) for form in forms])
+	total = db.execute("SELECT COUNT(*) FROM phon").fetchone()[0]
+	if total > args.cache_size:
+		db.execute("DELETE FROM phon WHERE rowid IN (SELECT rowid FROM phon ORDER BY used LIMIT ?)", (total - args.cache_size,))
+	db.commit()
 
-esplan = {}
-for langkey in supported_languages:
-	esplan[langkey] = langkey
-	esplan[supported_languages[langkey]] = langkey
+def phonemize_words(backend, langid, words):
+	# Phonemize a list of words, transcribing each distinct form only once
+	forms = list(dict.fromkeys(words))
+	db = None
+	if args.cache:
+		db = sqlite3.connect(args.cache, timeout=60)
+		db.execute("CREATE TABLE IF NOT EXISTS phon (lang TEXT, sep TEXT, form TEXT, phon TEXT, used REAL, PRIMARY KEY (lang, sep, form))")
+		cache_lookup(db, langid, [form for form in forms if not (langid, args.sep, form) in memo])
+	todo = [form for form in forms if not (langid, args.sep, form) in memo]
+	if todo:
+		phons = backend.phonemize(todo, separator=separator, strip=True, njobs=espeakjobs)
+		for form, phon in zip(todo, phons):
+			memo[(langid, args.sep, form)] = phon.strip()
+	if db is not None:
+		cache_store(db, langid, forms)
+		db.close()
+	return [memo[(langid, args.sep, word)] for word in words]
+
+def language_aliases(langit):
+	# The names under which a langcodes Language can be referred to
+	aliases = [str(langit), langit.display_name()]
 	try:
-		langit = Language.find(supported_languages[langkey])
+		aliases.append(langit.to_alpha3())
 	except LookupError as e:
-		continue
-	esplan[str(langit)] = langkey
-	esplan[langit.display_name()] = langkey
-	esplan[langit.to_alpha3()] = langkey
-	
-langnode = xmlf.find("//langUsage/language")
-langcode = args.lang
-if langnode is not None and not langcode: 
-	langcode = str(langnode.text)
-	args.lang = langcode
-if not langcode:
-	print ("Please specify a language (if not specified in XML)")
-	exit()
-
-langid = esplan[langcode]
-try:
-	langit = Language.find(langcode)
-except LookupError as e:
-	print ("No found a language for: ", langcode)
-	exit()
-	
-if not langid:
-	langit = Language.find(langcode)
-	langcode = langit.display_name()
-	langid = esplan[langcode]
-
-if not langid:
-	print ("No support for: ", args.lang)
-	exit()
-	
-print ("Language: ", str(langid), langit.display_name())
-
-# initialize the espeak backend for English
-try:
-	backend = EspeakBackend(str(langid))
-except RuntimeError as e:
-	print (e)
-	exit()
-
-for tok in xmlf.iter('tok'):
-	word = tok.text
-	if not word: 
-		continue
-	phon = backend.phonemize([word], separator=separator, strip=True)[0].strip()
-	if phon and ( args.force or not args.attr in tok.attrib ):
-		tok.attrib[args.attr] = phon
+		pass
+	return aliases
+
+def build_esplan():
+	# Map all aliases of all supported languages onto their espeak code (slow)
+	esplan = {}
+	for langkey in supported_languages:
+		esplan[langkey] = langkey
+		esplan[supported_languages[langkey]] = langkey
+		try:
+			langit = Language.find(supported_languages[langkey])
+		except LookupError as e:
+			continue
+		for alias in language_aliases(langit):
+			esplan[alias] = langkey
+	return esplan
+
+def resolve_language(langcode):
+	# Find the espeak code for the requested language only
+	if langcode in supported_languages:
+		return langcode
+	for langkey in supported_languages:
+		if supported_languages[langkey] == langcode:
+			return langkey
+	aliases = []
+	for lookup in (Language.find, Language.get):
+		try:
+			aliases.extend(language_aliases(lookup(langcode)))
+		except (LookupError, ValueError) as e:
+			continue
+	for alias in aliases:
+		if alias in supported_languages:
+			return alias
+	# Fall back to mapping all supported languages
+	esplan = build_esplan()
+	for alias in [langcode] + aliases:
+		if alias in esplan:
+			return esplan[alias]
+	return None
+
+def file_language(filename):
+	# Read the language from the teiHeader, without parsing the whole file
+	for event, elm in etree.iterparse(filename, events=("start", "end")):
+		if event == "start" and elm.tag == "text":
+			break
+		if event == "end" and elm.tag == "language" and elm.getparent() is not None and elm.getparent().tag == "langUsage":
+			return str(elm.text)
+	return None
+
+def get_backend(langid):
+	# One espeak backend per language (per process)
+	if not langid in backends:
+		backends[langid] = EspeakBackend(str(langid))
+	return backends[langid]
+
+def phonemize_xml(xmlf, langid):
+	# Collect the tokens to transcribe, and phonemize them in a single batch; returns the number of new transcriptions
+	toks = []
+	words = []
+	for tok in xmlf.iter('tok'):
+		word = tok.text
+		if not word: 
+			continue
+		if args.force or not args.attr in tok.attrib:
+			toks.append(tok)
+			words.append(word.replace("\n", " "))
+	if not toks:
+		return 0
+
+	phons = phonemize_words(get_backend(langid), str(langid), words)
+	cnt = 0
+	for tok, phon in zip(toks, phons):
+		if phon:
+			tok.attrib[args.attr] = phon
+			cnt = cnt + 1
+	return cnt
+
+def init_worker(languages):
+	global supported_languages, espeakjobs
+	supported_languages = languages
+	espeakjobs = 1
+
+def phonemize_file(filename, langid):
+	# Worker for the folder mode
+	try:
+		xmlf = etree.parse(filename)
+		cnt = phonemize_xml(xmlf, langid)
+		if cnt == 0:
+			return filename + ": skipped"
+		xmlf.write(filename,encoding="UTF-8")	
+	except Exception as e:
+		return filename + ": failed - " + str(e)
+	return filename + ": " + str(cnt) + " tokens"
+
+def phonemize_folder(folder):
+	# Phonemize all XML files in a folder, grouped by language
+	groups = {}
+	for root, dirs, files in os.walk(folder):
+		for name in sorted(files):
+			if not name.endswith(".xml"):
+				continue
+			filename = os.path.join(root, name)
+			langcode = args.lang or file_language(filename)
+			if not langcode:
+				print ("No language for: ", filename)
+				continue
+			if not langcode in groups:
+				groups[langcode] = []
+			groups[langcode].append(filename)
+
+	jobs = []
+	for langcode in groups:
+		langid = resolve_language(langcode)
+		if not langid:
+			print ("No support for: ", langcode, "-", len(groups[langcode]), "files skipped")
+			continue
+		print ("Language: ", str(langid), supported_languages[langid], "-", len(groups[langcode]), "files")
+		for filename in groups[langcode]:
+			jobs.append((filename, langid))
+
+	if args.jobs > 1:
+		with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(supported_languages,)) as pool:
+			results = pool.map(phonemize_file, [job[0] for job in jobs], [job[1] for job in jobs])
+			for result in results:
+				print (result)
+	else:
+		for filename, langid in jobs:
+			print (phonemize_file(filename, langid))
+
+# separate phones by a space and ignoring words boundaries
+separator = Separator(phone=args.sep, word=None)
+espeakjobs = args.jobs
+backends = {}
+
+if __name__ == "__main__":
+	# Get the list of supported languages
+	supported_languages = EspeakBackend.supported_languages()
+	checkpoint("supported languages")
+
+	if args.languages:
+		print ("Supported languages:")
+		print (supported_languages)
+		exit()
+
+	if os.path.isdir(args.file):
+		phonemize_folder(args.file)
+		exit()
+
+	xmlf = etree.parse(args.file)
+	checkpoint("parse XML")
+
+	langnode = xmlf.find("//langUsage/language")
+	langcode = args.lang
+	if langnode is not None and not langcode: 
+		langcode = str(langnode.text)
+		args.lang = langcode
+	if not langcode:
+		print ("Please specify a language (if not specified in XML)")
+		exit()
+
+	langid = resolve_language(langcode)
+	if not langid:
+		print ("No support for: ", args.lang)
+		exit()
+	checkpoint("language resolution")
 		
-xmlf.write(args.file,encoding="UTF-8")	
-print('Output written back to ' + args.file)
-	
+	print ("Language: ", str(langid), supported_languages[langid])
+
+	# initialize the espeak backend
+	try:
+		get_backend(langid)
+	except RuntimeError as e:
+		print (e)
+		exit()
+	checkpoint("espeak backend")
+
+	phonemize_xml(xmlf, langid)
+	checkpoint("phonemization")
+			
+	xmlf.write(args.file,encoding="UTF-8")	
+	print('Output written back to ' + args.file)
+	checkpoint("write XML")
+
+	if args.profile_startup:
+		print ("Timing (seconds):")
+		for label, duration in timings:
+			print ("  %-20s %8.3f" % (label, duration))
@@ -1,21 +1,36 @@
 from cassis import *
 import lxml.etree as etree
-import sys
+import sys, os, gzip
+from teitokdoc import scan_document, get_spangrp
+from castypes import get_typesystem
+from bisect import bisect_left, bisect_right
 
 def getval(node, attr):
 	if attr in node.keys():
 		return node.attrib[attr]
 	return ""
+
+def snap_span(begin, end, tokpos):
+	# Extend a character span to the full tokens it overlaps
+	begins, beginids, ends, endids = tokpos
+	i = max(bisect_right(begins, begin) - 1, 0)
+	j = min(bisect_left(ends, end), len(ends) - 1)
+	return beginids[i], endids[j]
 	
+def load_cas(infile, typesystem):
+	# Load a CAS in XMI or JSON format, optionally gzip-compressed, as written by teitok2cas.py
+	name = infile
+	opener = open
+	if name.endswith(".gz"):
+		name = name[:-3]
+		opener = gzip.open
+	with opener(infile, 'rb') as f:
+		if name.endswith(".json"):
+			return load_cas_from_json(f, typesystem=typesystem)
+		return load_cas_from_xmi(f, typesystem=typesystem)
+
 def readback(filename):
-	if "types" in cargs.keys():
-		typefile = cargs["types"]
-	else:
-		typefile = "/Users/mjanssen/Git/dkpro-cassis/tests/test_files/typesystems/inception_typesystem.xml"
-	if "verbose" in cargs.keys():
-		print("Using TypeSystem from file: " + typefile)
-	with open(typefile, 'rb') as f:
-		typesystem = load_typesystem(f)
+	typesystem = get_typesystem(cargs.get("types"), "verbose" in cargs.keys())
 	
 	Token = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Token')
 	Sentence = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Sentence')
@@ -29,43 +44,31 @@ def readback(filename):
 		infile = cargs["infile"]
 	else:
 		infile = filename.replace('.xml', '.xmi')
+		for ext in ('.xmi.gz', '.json', '.json.gz'):
+			if not os.path.exists(infile) and os.path.exists(filename.replace('.xml', ext)):
+				infile = filename.replace('.xml', ext)
 	xmlf = etree.parse(filename)
-	toks = {}
 	tokfrom = {}
 	tokto = {}
-	id2idx = {}
-	docend = -1
 
 	# Deal with NameSpace if needed
 	xmlns = xmlf.getroot().nsmap
 	if None in xmlns.keys() and not "tei" in xmlns.keys():
 		xmlns["tei"] = xmlns[None]
-	if "tokxp" in cargs.keys():
-		tokxp = cargs['tokxp']
-		tokres = xmlf.findall(tokxp, xmlns)
-	elif xmlns:
-		tokxp = "//tei:text//tei:tok"
-		tokres = xmlf.findall(tokxp, xmlns)
-	else:
-		tokxp = "//text//tok"
-		tokres = xmlf.findall(tokxp)
 
-	tokcnt = 0
-	for tok in tokres:
-		tokid = tok.attrib['id']
-		toks[tokid] = tok
-		id2idx[tokid] = tokcnt
-		tokcnt = tokcnt+1 
+	# Collect the tokens, spanGrps and highest ANN number in a single pass
+	xmldoc = scan_document(xmlf, cargs.get('tokxp'), xmlns)
+	toks = xmldoc['toks']
 	idlist = list(toks.keys())
+	id2idx = {}
+	for tokcnt, tokid in enumerate(idlist):
+		id2idx[tokid] = tokcnt
 
-	with open(infile, 'rb') as f:
-	   cas = load_cas_from_xmi(f, typesystem=typesystem)
+	cas = load_cas(infile, typesystem)
 
 	# Read back the token based data
 	for token in cas.select('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Token'):
 		tokid = token.id
-		if token.end > docend:
-			docend = token.end
 		if not tokid:
 			print('Token without an ID')
 			print(token)
@@ -104,43 +107,30 @@ def readback(filename):
 			print("Dependency " + id1 + " /" + deprel + "/ " + id2 + " -> " + etree.tostring(toks[id1], encoding='unicode', method='xml'))
 
 		
-	# Find the highest ANN number	
-	annid = 1;
-	spans = xmlf.findall("//{*}span")
-	if spans is not None:
-		for span in spans:
-			spanid = span.get('id')
-			if spanid[0:4] == "ann-":
-				thisid = int(spanid[4:])
-				if thisid >= annid:
-					annid = thisid + 1
+	# Sorted token offsets for snapping spans to token boundaries
+	begins = sorted(tokfrom.keys())
+	ends = sorted(tokto.keys())
+	tokpos = (begins, [tokfrom[p] for p in begins], ends, [tokto[p] for p in ends])
+
+	annid = xmldoc['annid']
 	
 	# Read back the Chunks
-	chunkxml = xmlf.find("//{*}spanGrp[@type=\"chunks\"]")
-	if not chunkxml:
-		chunkxml = etree.Element("spanGrp")
-		chunkxml.set("type", "chunks")	
+	chunkxml, chunkidx = get_spangrp(xmldoc, "chunks")
 	firstann = annid
 	for chunk in cas.select('de.tudarmstadt.ukp.dkpro.core.api.syntax.type.chunk.Chunk'):
 		# Extend to full tokens
-		p1 = chunk.begin
-		while p1 > 0 and not p1 in tokfrom.keys():
-			p1 = p1 - 1 
-		p2 = chunk.end
-		while p2 < docend and not p2 in tokto.keys():
-			p2 = p2 + 1 
-		tok1 = tokfrom[p1]
-		tok2 = tokto[p2]
+		tok1, tok2 = snap_span(chunk.begin, chunk.end, tokpos)
 		idspan = idlist[id2idx[tok1]:id2idx[tok2]+1]
 		corresp = "#" + " #".join(idspan)
 		if "debug" in cargs.keys():
 			print("Chunk " + tok1 + " - " + tok2 + ": " + chunk.chunkValue)
-		annelm = chunkxml.find(".//{*}span[@corresp=\""+corresp+"\"]")
+		annelm = chunkidx.get(corresp)
 		if annelm is None:
 			annelm = etree.Element("span")
 			annelm.set("id", "ann-"+str(annid))
 			annelm.tail = "\n"
 			chunkxml.append(annelm)
+			chunkidx[corresp] = annelm
 		annid = annid + 1
 		annelm.set("value", chunk.chunkValue)
 		annelm.set("corresp", corresp)
@@ -150,32 +140,23 @@ def readback(filename):
 		xmlf.getroot().append(chunkxml)
 
 	# Read back the Named Entities
-	nerxml = xmlf.find("//{*}spanGrp[@type=\"entities\"]")
+	nerxml, neridx = get_spangrp(xmldoc, "entities")
 	firstann = annid
-	if nerxml is None:
-		nerxml = etree.Element("spanGrp")
-		nerxml.set("type", "entities")	
 	for ner in cas.select('de.tudarmstadt.ukp.dkpro.core.api.ner.type.NamedEntity'):
 		# Extend to full tokens
-		p1 = ner.begin
-		while p1 > 0 and not p1 in tokfrom.keys():
-			p1 = p1 - 1 
-		p2 = ner.end
-		while p2 < docend and not p2 in tokto.keys():
-			p2 = p2 + 1 
-		tok1 = tokfrom[p1]
-		tok2 = tokto[p2]
+		tok1, tok2 = snap_span(ner.begin, ner.end, tokpos)
 		idspan = idlist[id2idx[tok1]:id2idx[tok2]+1]
 		corresp = "#" + " #".join(idspan)
 		if "debug" in cargs.keys():
 			print("Named Entities " + tok1 + " - " + tok2 + ": " + ner.value)
-		annelm = nerxml.find(".//{*}span[@corresp=\""+corresp+"\"]")
+		annelm = neridx.get(corresp)
 		if annelm is None:
 			annelm = etree.Element("span")
 			annelm.set("id", "ann-"+str(annid))
 			annid = annid + 1
 			annelm.tail = "\n"
 			nerxml.append(annelm)
+			neridx[corresp] = annelm
 		annelm.set("type", ner.value)
 		annelm.set("corresp", corresp)
 	if "debug" in cargs.keys():
@@ -188,28 +169,29 @@ def readback(filename):
 		exit()
 	xmlf.write(filename)
 			
-fname = ""
-cargs = {}
-for arg in sys.argv[1:]:
-	if arg[0:1] == "-":
-		tmp = arg[2:].split("=")
-		if len(tmp) == 1:
-			tmp.append(1);
-		cargs[tmp[0]] = tmp[1]
-	else:
-		fname = arg
-if "file" in cargs.keys():
-	fname = cargs['file']
-if fname == "":
-	cargs["help"] = 1
+if __name__ == "__main__":
+	fname = ""
+	cargs = {}
+	for arg in sys.argv[1:]:
+		if arg[0:1] == "-":
+			tmp = arg[2:].split("=")
+			if len(tmp) == 1:
+				tmp.append(1);
+			cargs[tmp[0]] = tmp[1]
+		else:
+			fname = arg
+	if "file" in cargs.keys():
+		fname = cargs['file']
+	if fname == "":
+		cargs["help"] = 1
 
-if "debug" in cargs.keys():
-	cargs["verbose"] = 1
-if "verbose" in cargs.keys() and fname:
-	print("Processing XML file: " + fname)
+	if "debug" in cargs.keys():
+		cargs["verbose"] = 1
+	if "verbose" in cargs.keys() and fname:
+		print("Processing XML file: " + fname)
 
-if "help" in cargs.keys():
-	print('''Usage: python cas2teitok.py [options] FILENAME
+	if "help" in cargs.keys():
+		print('''Usage: python cas2teitok.py [options] FILENAME
 
 Options:
 --help         : show this help
@@ -217,9 +199,9 @@ Options:
 --debug        : debug mode
 --test         : print output to STDOUT
 --file=FILE    : XML filename for readback
---infile=FILE  : XMI input filename
---types=FILE   : TypeSystem filename
+--infile=FILE  : CAS input filename (.xmi or .json, optionally .gz)
+--types=FILE   : TypeSystem filename (default: $TEITOK_TYPESYSTEM or inception_typesystem.xml)
 ''')
-	exit()
+		exit()
 
-readback(fname)
\ No newline at end of file
+	readback(fname)
@@ -1,5 +1,8 @@
+from concurrent.futures import ProcessPoolExecutor
 import lxml.etree as etree
-import sys
+import sys, os
+from teitokdoc import scan_document, get_spangrp
+from conllureader import read_sentences
 
 def getval(node, attr):
 	if attr in node.keys():
@@ -9,186 +12,261 @@ def getval(node, attr):
 concols = ['ord', 'form', 'lemma', 'upos', 'xpos', 'feats', 'ohead', 'deprel', 'dep', 'misc']
 
 	
-def readback(filename):
-	
-	if "infile" in cargs.keys():
-		infile = cargs["infile"]
-	else:
-		infile = filename.replace('.xml', '.conllu')
-	if "verbose" in cargs.keys():
-		print("Reading back conllu file: " + infile)
-	xmlf = etree.parse(filename)
-
-	annid = 1;
-	spans = xmlf.findall("//{*}span")
-	if spans is not None:
-		for span in spans:
-			spanid = span.get('id')
-			if spanid[0:4] == "ann-":
-				thisid = int(spanid[4:])
-				if thisid >= annid:
-					annid = thisid + 1
-
-	# Deal with NER 
-	nerxml = xmlf.find("//{*}spanGrp[@type=\"entities\"]")
-	firstann = annid
-	if nerxml is None:
-		nerxml = etree.Element("spanGrp")
-		nerxml.set("type", "entities")	
-	
-	# Deal with NameSpace if needed
-	xmlns = xmlf.getroot().nsmap
-	if None in xmlns.keys() and not "tei" in xmlns.keys():
-		xmlns["tei"] = xmlns[None]
-	if "tokxp" in cargs.keys():
-		tokxp = cargs['tokxp']
-		tokres = xmlf.findall(tokxp, xmlns)
-	elif xmlns:
-		tokxp = "//tei:text//tei:tok"
-		tokres = xmlf.findall(tokxp, xmlns)
-	else:
-		tokxp = "//text//tok"
-		tokres = xmlf.findall(tokxp)
-		
-	
-	if "debug" in cargs.keys():
-		print("Token XPath: " + tokxp)
-	
-	toks = {}
-	nes = {}
+def readback_sentence(sent, toks, ner):
+	# Put the data of a single CoNLL-U sentence back onto the TEITOK tokens
 	id2ord = {}
 	ord2id = {}
-	docend = -1
-	for tok in tokres:
-		tokid = tok.attrib['id']
-		toks[tokid] = tok
-
-	conllu = open(infile, 'r')
-
-	# Read back the token based data
-	for line in conllu:
-		data = line.replace("\n", "")
-		if data == "":
-			# End of sentence - calculate head from ohead
-			for tokid in id2ord:
-				tok = toks[tokid]
-				if not "ohead" in tok.attrib.keys():
-					continue
-				ohead = tok.attrib['ohead']
-				if not ohead in ord2id.keys():
-					if ohead != "0":
-						print("ohead not found in sentence: " + tokid  + " => " + ohead )
-					continue
-				thead = ord2id[ohead]
-				tok.attrib['head'] = thead
-			for j in nes:
-				ne = nes[j]
-				if "debug" in cargs.keys():
-					print("Named Entity " + j + ": " + str(ne))
-				for i in ne["ords"]:
-					corresp = " #" + ord2id[i]
-				corresp = corresp[1:]
-				annelm = nerxml.find(".//{*}span[@corresp=\""+corresp+"\"]")
-				if annelm is None:
-					annelm = etree.Element("span")
-					annelm.set("id", "ann-"+str(annid))
-					annid = annid + 1
-					annelm.tail = "\n"
-					nerxml.append(annelm)
-				annelm.set("type", ne["type"])
-				annelm.set("corresp", corresp)
-			id2ord = {}
-			ord2id = {}
-			nes = {}
-		elif data[0:1] == "#":
-			# Metadata or comment line
+	nes = {}
+	for word in sent.words:
+		if word.kind == "empty":
+			# Empty nodes (enhanced dependencies only) have no counterpart in the XML
 			continue
-		else:
-			flds = data.split("\t")
-			misc = flds[9].split('|')
-			ord = flds[0]
-			tokid = ""
-			join = ""
-			for mf in misc:
-				mfa = mf.split("=")
-				if mfa[0] == "tokId" or mfa[0] == "tok_id":
-					# TEITOK style token ID
-					tokid = mfa[1]
-				if mfa[0] == "NE":
-					# CoNLL-U+NE style Named Entity
-					tmp = mfa[1].split("_")
-					if not tmp[1] in nes.keys():
-						nes[tmp[1]] = {"type": tmp[0], "ords": [ord] }
-					else:
-						nes[tmp[1]]["ords"].append(ord)
-				elif not "=" in mf:
-					# Old TEITOK style token ID
-					tokid = mf
-			if tokid == "":
-				if "debug" in cargs.keys():
-					print("Token line without a tokid: " + data)
-				continue
-			if not tokid in toks.keys():
-				if "debug" in cargs.keys():
-					print("Unknown tokid: " + tokid)
-				continue
-			tok = toks[tokid]
+		flds = word.cols
+		ord = word.ord
+		tokid = ""
+		join = ""
+		for key, val in word.misc:
+			if val is None:
+				# Old TEITOK style token ID
+				tokid = key
+			elif key == "tokId" or key == "tok_id":
+				# TEITOK style token ID
+				tokid = val
+			elif key == "NE":
+				# CoNLL-U+NE style Named Entity
+				tmp = val.split("_")
+				if not tmp[1] in nes.keys():
+					nes[tmp[1]] = {"type": tmp[0], "ords": [ord] }
+				else:
+					nes[tmp[1]]["ords"].append(ord)
+			elif key == "SpaceAfter" and val == "No":
+				join = "right"
+		if tokid == "":
+			if "debug" in cargs.keys():
+				print("Token line without a tokid: " + "\t".join(flds))
+			continue
+		if not tokid in toks.keys():
+			if "debug" in cargs.keys():
+				print("Unknown tokid: " + tokid)
+			continue
+		tok = toks[tokid]
+		if word.kind == "word":
+			# A multiword token (1-2) is the <tok>; its words are the <dtok>s
 			id2ord[tokid] = ord
 			ord2id[ord] = tokid
-			
-			# Check that this is the right word
-			cform = flds[1]
-			xform = tok.text
-			if "form" in tok.attrib.keys():
-				xform = tok.get("form")
-			if cform != xform:
-				print ("Verification mismatch: " + tokid + " => " + cform + " =/= " + xform)
+		
+		# Check that this is the right word
+		cform = word.form
+		xform = tok.text
+		if "form" in tok.attrib.keys():
+			xform = tok.get("form")
+		if cform != xform:
+			print ("Verification mismatch: " + tokid + " => " + cform + " =/= " + str(xform))
+			continue
+					
+		# Put back the fields
+		if join != "" and "join" in cargs.keys():
+			tok.set("join", join)
+		if word.kind == "multi":
+			# The annotation is on the words of the multiword token
+			continue
+		for cc, conf in enumerate(concols[:len(flds)]):
+			if conf == "form":
+				continue
+			if flds[cc] == "" or flds[cc] == "_":
 				continue
-						
-			# Put back the fields
-			if join != "" and "join" in cargs.keys():
-				tok.set("join", join)
-			cc = -1
-			for conf in concols:
-				cc = cc+1 
-				if conf == "form":
-					continue
-				if flds[cc] == "" or flds[cc] == "_":
-					continue
-				if "debug" in cargs.keys():
-					print (str(cc) + " - " + conf + " > " + flds[cc])
-				tok.attrib[conf] = flds[cc]
-			
 			if "debug" in cargs.keys():
-				print("Token " + tokid + " -> " + etree.tostring(tok, encoding='unicode', method='xml'))
+				print (str(cc) + " - " + conf + " > " + flds[cc])
+			tok.attrib[conf] = flds[cc]
+		
+		if "debug" in cargs.keys():
+			print("Token " + tokid + " -> " + etree.tostring(tok, encoding='unicode', method='xml'))
+
+	# End of sentence - calculate head from ohead
+	for tokid in id2ord:
+		tok = toks[tokid]
+		if not "ohead" in tok.attrib.keys():
+			continue
+		ohead = tok.attrib['ohead']
+		if not ohead in ord2id.keys():
+			if ohead != "0":
+				print("ohead not found in sentence: " + tokid  + " => " + ohead )
+			continue
+		thead = ord2id[ohead]
+		tok.attrib['head'] = thead
+	for j in nes:
+		ne = nes[j]
+		if "debug" in cargs.keys():
+			print("Named Entity " + j + ": " + str(ne))
+		corresp = ""
+		for i in ne["ords"]:
+			if i in ord2id.keys():
+				corresp = corresp + " #" + ord2id[i]
+		corresp = corresp[1:]
+		if corresp == "":
+			continue
+		annelm = ner['idx'].get(corresp)
+		if annelm is None:
+			annelm = etree.Element("span")
+			annelm.set("id", "ann-"+str(ner['annid']))
+			ner['annid'] = ner['annid'] + 1
+			annelm.tail = "\n"
+			ner['xml'].append(annelm)
+			ner['idx'][corresp] = annelm
+		annelm.set("type", ne["type"])
+		annelm.set("corresp", corresp)
+
+def readback_doc(filename, sentences):
+	# Read back a sequence of CoNLL-U sentences into a single XML file
+	xmlf = etree.parse(filename)
+
+	# Deal with NameSpace if needed
+	xmlns = xmlf.getroot().nsmap
+	if None in xmlns.keys() and not "tei" in xmlns.keys():
+		xmlns["tei"] = xmlns[None]
+	if "debug" in cargs.keys() and "tokxp" in cargs.keys():
+		print("Token XPath: " + cargs['tokxp'])
+
+	# Collect the tokens, spanGrps and highest ANN number in a single pass
+	xmldoc = scan_document(xmlf, cargs.get('tokxp'), xmlns)
+	toks = xmldoc['toks']
+	if xmldoc['dtoks']:
+		# The words of multiword tokens are <dtok>s
+		toks = dict(toks)
+		toks.update(xmldoc['dtoks'])
+
+	# Deal with NER 
+	nerxml, neridx = get_spangrp(xmldoc, "entities")
+	ner = {'xml': nerxml, 'idx': neridx, 'annid': xmldoc['annid']}
+
+	# Read back the token based data, one sentence at a time
+	for sent in sentences:
+		readback_sentence(sent, toks, ner)
+
+	if ner['annid'] > xmldoc['annid'] and nerxml.getparent() is None:
+		xmlf.getroot().append(nerxml)
 		
 	if "test" in cargs.keys():
 		print(etree.tostring(xmlf, pretty_print=True, encoding='unicode', method='xml'))
-		exit()
-	xmlf.write(filename)
-			
-fname = ""
-cargs = {}
-for arg in sys.argv[1:]:
-	if arg[0:1] == "-":
-		tmp = arg[2:].split("=")
-		if len(tmp) == 1:
-			tmp.append(1);
-		cargs[tmp[0]] = tmp[1]
+		return
+	# Write to a temporary file first, so that the XML is never left half-written
+	tmpfile = filename + ".tmp"
+	xmlf.write(tmpfile)
+	os.replace(tmpfile, filename)
+
+def readback(filename):
+	
+	if "infile" in cargs.keys():
+		infile = cargs["infile"]
 	else:
-		fname = arg
-if "file" in cargs.keys():
-	fname = cargs['file']
-if fname == "":
-	cargs["help"] = 1
+		infile = filename.replace('.xml', '.conllu')
+	if "verbose" in cargs.keys():
+		print("Reading back conllu file: " + infile)
+
+	with open(infile, 'r') as conllu:
+		readback_doc(filename, read_sentences(conllu))
+
+def init_worker(options):
+	global cargs
+	cargs = options
+
+def readback_block(filename, sentences):
+	# Worker for the multi-document mode: report errors instead of stopping
+	try:
+		readback_doc(filename, sentences)
+	except Exception as e:
+		return filename + ": " + str(e)
+	return ""
+
+def readback_multi(infile):
+	# Read a single CoNLL-U file with "# newdoc id = ..." markers back into one XML file per document
+	folder = cargs.get("folder", "xmlfiles")
+	jobs = int(cargs.get("jobs", 1))
+	if "verbose" in cargs.keys():
+		print("Reading back multi-document conllu file: " + infile)
 
-if "debug" in cargs.keys():
-	cargs["verbose"] = 1
-if "verbose" in cargs.keys() and fname:
-	print("Processing XML file: " + fname)
+	pool = None
+	if jobs > 1:
+		pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(cargs,))
+	pending = []
+	errors = []
+	doccnt = 0
 
-if "help" in cargs.keys():
-	print('''Usage: python readback_conllu.py [options] FILENAME
+	def flush(docid, sentences):
+		xmlfile = os.path.join(folder, docid)
+		if not xmlfile.endswith(".xml"):
+			xmlfile = xmlfile + ".xml"
+		if not os.path.exists(xmlfile):
+			errors.append(xmlfile + ": no such file")
+			return
+		if "verbose" in cargs.keys():
+			print("Processing XML file: " + xmlfile)
+		if pool is None:
+			errors.append(readback_block(xmlfile, sentences))
+			return
+		# Keep the number of documents held in memory bounded
+		while len(pending) >= 2*jobs:
+			errors.append(pending.pop(0).result())
+		pending.append(pool.submit(readback_block, xmlfile, sentences))
+
+	docid = None
+	sentences = []
+	with open(infile, 'r') as conllu:
+		for sent in read_sentences(conllu):
+			meta = sent.meta()
+			if "newdoc id" in meta.keys():
+				if docid is not None:
+					flush(docid, sentences)
+					doccnt = doccnt + 1
+				docid = meta["newdoc id"]
+				sentences = []
+			elif "newdoc" in meta.keys() and docid is None:
+				print("Document without an id in: " + infile)
+			if docid is None:
+				continue
+			sentences.append(sent)
+	if docid is not None:
+		flush(docid, sentences)
+		doccnt = doccnt + 1
+
+	if pool is not None:
+		for future in pending:
+			errors.append(future.result())
+		pool.shutdown()
+
+	errors = [error for error in errors if error]
+	for error in errors:
+		print("Failed: " + error)
+	print("Read back " + str(doccnt-len(errors)) + " of " + str(doccnt) + " documents")
+	if errors:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	fname = ""
+	cargs = {}
+	for arg in sys.argv[1:]:
+		if arg[0:1] == "-":
+			tmp = arg[2:].split("=")
+			if len(tmp) == 1:
+				tmp.append(1);
+			cargs[tmp[0]] = tmp[1]
+		else:
+			fname = arg
+	if "file" in cargs.keys():
+		fname = cargs['file']
+	if "multi" in cargs.keys() and "infile" in cargs.keys():
+		fname = cargs['infile']
+	if fname == "":
+		cargs["help"] = 1
+
+	if "debug" in cargs.keys():
+		cargs["verbose"] = 1
+	if "verbose" in cargs.keys() and fname and not "multi" in cargs.keys():
+		print("Processing XML file: " + fname)
+
+	if "help" in cargs.keys():
+		print('''Usage: python readback_conllu.py [options] FILENAME
+       python readback_conllu.py --multi [options] CONLLUFILE
 
 Options:
 --help         : show this help
@@ -199,7 +277,13 @@ Options:
 --tokxp        : XPath query for tokens
 --file=FILE    : XML filename for readback
 --infile=FILE  : CoNLL-U input filename
+--multi        : CoNLL-U file with several documents (# newdoc id = ...)
+--folder=DIR   : folder with the XML files for --multi (default: xmlfiles)
+--jobs=N       : number of parallel worker processes for --multi (default: 1)
 ''')
-	exit()
+		exit()
 
-readback(fname)
\ No newline at end of file
+	if "multi" in cargs.keys():
+		readback_multi(fname)
+	else:
+		readback(fname)
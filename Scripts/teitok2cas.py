@@ -1,139 +1,282 @@
 from cassis import *
+from concurrent.futures import ProcessPoolExecutor
 import lxml.etree as etree
-import sys
+import sys, os, glob, gzip, time, traceback
+from castypes import get_typesystem
 
 
+class NotConvertible(ValueError):
+	# The document lacks the structure needed for a CAS (tokens, sentences)
+	pass
+
 def getval(node, attr):
 	if attr in node.keys():
 		return node.attrib[attr]
 	return ""
 	
 	
-with open('/Users/mjanssen/Git/dkpro-cassis/tests/test_files/typesystems/inception_typesystem.xml', 'rb') as f:
-    typesystem = load_typesystem(f)
+def init_types(options):
+	# Load the TypeSystem once per process (called for the main process and for each worker)
+	global cargs, typesystem, Token, Sentence, Document, Pos, Lemma, Morf, Deps
+	cargs = options
+	typesystem = get_typesystem(cargs.get("types"), "verbose" in cargs.keys())
+
+	Token = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Token')
+	Sentence = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Sentence')
+	Document = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.metadata.type.DocumentMetaData')
+	Pos = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.lexmorph.type.pos.POS')
+	Lemma = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Lemma')
+	Morf = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.lexmorph.type.morph.MorphologicalFeatures')
+	Deps = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.syntax.type.dependency.Dependency')
+
+def add_sentence(cas, sentid, stoks, doc):
+	# Add the tokens of a single sentence to the CAS and the sofa
+	sentbegin = doc['end'] + 1
+	end = doc['end']
+	toks = doc['toks']
+	for tok in stoks:
+		word = tok.text
+		tokid = tok.attrib['id']
+		strlen = len(word)
+		begin = end + 1
+		end += strlen + 1
+		toks[tokid] = Token(begin=begin, end=end, id=tokid)
+		if "upos" in tok.keys() or "xpos"  in tok.keys():
+			tpos = Pos(begin=begin, end=end, coarseValue=getval(tok, "upos"), PosValue=getval(tok, "xpos"))
+			toks[tokid].pos = tpos
+			cas.add(tpos)
+		if "lemma" in tok.keys():
+			tlemma = Lemma(begin=begin, end=end, value=tok.attrib["lemma"])
+			cas.add(tlemma)
+			toks[tokid].lemma = tlemma
+		if "feats" in tok.keys():
+			tmorf = Morf(begin=begin, end=end, value=tok.attrib["feats"])
+			toks[tokid].morph = tmorf
+			cas.add(tmorf)
+		if "debug" in cargs.keys():
+			print(tokid + ': ' + word + " -> " + str(strlen) + " = " + str(begin) + " - " + str(end))
+		doc['sofa'].append(word)
+		if "head" in tok.keys() and "deprel"  in tok.keys():
+			doc['deprels'].append({'Governor': tokid, 'Dependent': tok.attrib['head'], 'DependencyType': tok.attrib['deprel']})
+		cas.add(toks[tokid])
+	if end > sentbegin:
+		cas.add(Sentence(begin=sentbegin, end=end, id=sentid))
+	doc['end'] = end
+
+def finish(cas, filename, doc):
+	toks = doc['toks']
+	for deprel in doc['deprels']:
+		tok1 = toks[deprel['Governor']]
+		tok2 = toks[deprel['Dependent']]
+		cas.add(Deps(Governor=tok1, Dependent=tok2, DependencyType=deprel['DependencyType'], flavor="basic", begin=tok2['begin'], end=tok2['end']))
+
+	# Add the full string to the sofa
+	cas.sofa_string = " ".join(doc['sofa'])
+	built = time.perf_counter()
+
+	# Serialize the CAS once, in the requested format
+	outformat = cargs.get("format", "xmi")
+	if outformat == "json":
+		serialize = cas.to_json
+	else:
+		serialize = cas.to_xmi
+	ext = "." + outformat
+	if "gzip" in cargs.keys():
+		ext = ext + ".gz"
+
+	if "test" in cargs.keys():
+		print(serialize())
+		return
 
-Token = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Token')
-Sentence = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Sentence')
-Document = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.metadata.type.DocumentMetaData')
-Pos = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.lexmorph.type.pos.POS')
-Lemma = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Lemma')
-Morf = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.lexmorph.type.morph.MorphologicalFeatures')
-Deps = typesystem.get_type('de.tudarmstadt.ukp.dkpro.core.api.syntax.type.dependency.Dependency')
+	if "outfile" in cargs.keys() and not "batch" in cargs.keys():
+		outfile = cargs["outfile"]
+	else:
+		outfile = filename.replace('.xml', ext)
+	if "verbose" in cargs.keys():
+		print("Writing CAS " + outformat.upper() + " to " + outfile)
+	if "gzip" in cargs.keys():
+		with gzip.open(outfile, "wt", encoding="utf-8") as f:
+			f.write(serialize())
+	else:
+		serialize(outfile)
+
+	if "timing" in cargs.keys():
+		done = time.perf_counter()
+		print("%s: build %.3fs, write %.3fs, %d bytes" % (outfile, built - doc['start'], done - built, os.path.getsize(outfile)))
 
 def convert(filename):
 	xmlf = etree.parse(filename)
 	cas = Cas(typesystem=typesystem)
 
 	if len(xmlf.findall("//text//tok")) == 0:
-		print("Document not a TEITOK XML file or not tokenized")
-		exit()
+		raise NotConvertible("Document not a TEITOK XML file or not tokenized")
 	if len(xmlf.findall("//text//s")) == 0:
-		print("Document not segmented into sentences")
-		exit()
-
-	sofastr = ""
-	space = ""
+		raise NotConvertible("Document not segmented into sentences")
 
 	# Add all sentences with all tokens
 	sentcnt = 1
-	begin = -0
-	end = -1
-	toks = {}
-	deprels = []
+	doc = {'end': -1, 'sofa': [], 'toks': {}, 'deprels': [], 'start': time.perf_counter()}
+	id2elm = None
 	for sent in xmlf.findall("//text//s"):
 		sentid = "s-" + str(sentcnt)
 		sentcnt = sentcnt + 1
-		sentbegin = end + 1
 		if "id" in sent.keys():
 			sentid = sent.attrib['id']
 		if "debug" in cargs.keys():
 			print("-- " + sentid)
 		if "sameAs" in sent.keys():
+			if id2elm is None:
+				# Index all elements by @id once, to avoid a full tree scan per token
+				id2elm = {}
+				for elm in xmlf.iter(etree.Element):
+					if elm.get('id') is not None:
+						id2elm[elm.get('id')] = elm
 			stoks = []
 			for tokid in sent.attrib['sameAs'].split(" "):
-				tok = xmlf.find("//*[@id=\""+tokid[1:]+"\"]")
+				tok = id2elm.get(tokid[1:])
 				stoks.append(tok)
 		else:
 			stoks = sent.findall(".//tok")		
-		for tok in stoks:
-			word = tok.text
-			tokid = tok.attrib['id']
-			strlen = len(word)
-			begin = end + 1
-			end += strlen + 1
-			toks[tokid] = Token(begin=begin, end=end, id=tokid)
-			if "upos" in tok.keys() or "xpos"  in tok.keys():
-				tpos = Pos(begin=begin, end=end, coarseValue=getval(tok, "upos"), PosValue=getval(tok, "xpos"))
-				toks[tokid].pos = tpos
-				cas.add(tpos)
-			if "lemma" in tok.keys():
-				tlemma = Lemma(begin=begin, end=end, value=tok.attrib["lemma"])
-				cas.add(tlemma)
-				toks[tokid].lemma = tlemma
-			if "feats" in tok.keys():
-				tmorf = Morf(begin=begin, end=end, value=tok.attrib["feats"])
-				toks[tokid].morph = tmorf
-				cas.add(tmorf)
+		add_sentence(cas, sentid, stoks, doc)
+
+	finish(cas, filename, doc)
+
+def convert_stream(filename):
+	# Walk the sentences with iterparse, and clear them once they are in the CAS
+	cas = Cas(typesystem=typesystem)
+
+	sentcnt = 1
+	tokcnt = 0
+	intext = 0
+	doc = {'end': -1, 'sofa': [], 'toks': {}, 'deprels': [], 'start': time.perf_counter()}
+	for event, elm in etree.iterparse(filename, events=("start", "end")):
+		if elm.tag == "text":
+			if event == "start":
+				intext = intext + 1
+			else:
+				intext = intext - 1
+			continue
+		if event != "end" or not intext:
+			continue
+		if elm.tag == "tok":
+			tokcnt = tokcnt + 1
+		elif elm.tag == "s":
+			if "sameAs" in elm.keys():
+				# Stand-off sentences need random access to the tree
+				if "verbose" in cargs.keys():
+					print("Document uses @sameAs - falling back to non-streaming mode")
+				return convert(filename)
+			sentid = "s-" + str(sentcnt)
+			sentcnt = sentcnt + 1
+			if "id" in elm.keys():
+				sentid = elm.attrib['id']
 			if "debug" in cargs.keys():
-				print(tokid + ': ' + word + " -> " + str(strlen) + " = " + str(begin) + " - " + str(end))
-			sofastr += space + word
-			space = " "
-			if "head" in tok.keys() and "deprel"  in tok.keys():
-				deprels.append({'Governor': tokid, 'Dependent': tok.attrib['head'], 'DependencyType': tok.attrib['deprel']})
-			cas.add(toks[tokid])
-		if end > sentbegin:
-			cas.add(Sentence(begin=sentbegin, end=end, id=sentid))
-
-	for deprel in deprels:
-		tok1 = toks[deprel['Governor']]
-		tok2 = toks[deprel['Dependent']]
-		cas.add(Deps(Governor=tok1, Dependent=tok2, DependencyType=deprel['DependencyType'], flavor="basic", begin=tok2['begin'], end=tok2['end']))
+				print("-- " + sentid)
+			add_sentence(cas, sentid, elm.findall(".//tok"), doc)
+			elm.clear(keep_tail=True)
+			while elm.getprevious() is not None:
+				del elm.getparent()[0]
 
-	# Add the full string to the sofa
-	cas.sofa_string = sofastr
+	if tokcnt == 0:
+		raise NotConvertible("Document not a TEITOK XML file or not tokenized")
+	if sentcnt == 1:
+		raise NotConvertible("Document not segmented into sentences")
 
-	xmi = cas.to_xmi()    
-	# print(xmi)
+	finish(cas, filename, doc)
 
-	if "outfile" in cargs.keys():
-		outfile = cargs["outfile"]
-	else:
-		outfile = filename.replace('.xml', '.xmi')
-	if "verbose" in cargs.keys():
-		print("Writing CAS XMI to " + outfile)
-	cas.to_xmi(outfile)
-
-fname = ""
-cargs = {}
-for arg in sys.argv[1:]:
-	if arg[0:1] == "-":
-		tmp = arg[2:].split("=")
-		if len(tmp) == 1:
-			tmp.append(1);
-		cargs[tmp[0]] = tmp[1]
-	else:
-		fname = arg
-if "file" in cargs.keys():
-	fname = cargs['file']
-if fname == "":
-	cargs["help"] = 1
+def convert_file(filename):
+	# Convert a single file; documents that cannot be converted are reported instead of stopping
+	try:
+		if "stream" in cargs.keys():
+			convert_stream(filename)
+		else:
+			convert(filename)
+	except NotConvertible as e:
+		return (filename, str(e))
+	except Exception as e:
+		if not "batch" in cargs.keys():
+			raise
+		# Anything else is a bug: show where it happened, but carry on with the other files
+		print("Error in " + filename + ":\n" + traceback.format_exc(), file=sys.stderr)
+		return (filename, type(e).__name__ + ": " + str(e))
+	return (filename, "")
+
+if __name__ == "__main__":
+	fnames = []
+	cargs = {}
+	for arg in sys.argv[1:]:
+		if arg[0:1] == "-":
+			tmp = arg[2:].split("=")
+			if len(tmp) == 1:
+				tmp.append(1);
+			cargs[tmp[0]] = tmp[1]
+		else:
+			fnames.extend(sorted(glob.glob(arg)) or [arg])
+	if "file" in cargs.keys():
+		fnames = [cargs['file']]
+	if "folder" in cargs.keys():
+		fnames = sorted(glob.glob(os.path.join(cargs['folder'], "**", "*.xml"), recursive=True))
+	if not fnames and not "folder" in cargs.keys():
+		cargs["help"] = 1
+	if len(fnames) > 1 or "folder" in cargs.keys():
+		cargs["batch"] = 1
 
-if "debug" in cargs.keys():
-	cargs["verbose"] = 1
-if "verbose" in cargs.keys() and fname:
-	print("Processing XML file: " + fname)
+	if "debug" in cargs.keys():
+		cargs["verbose"] = 1
+	if cargs.get("format", "xmi") not in ("xmi", "json"):
+		print("Unknown output format: " + str(cargs["format"]))
+		exit()
+	if "verbose" in cargs.keys() and len(fnames) == 1:
+		print("Processing XML file: " + fnames[0])
 
-if "help" in cargs.keys():
-	print('''Usage: python teitok2cas.py [options] FILENAME
+	if "help" in cargs.keys():
+		print('''Usage: python teitok2cas.py [options] FILENAME [FILENAME...]
 
 Options:
---help         : show this help
---verbose      : verbose mode
---debug        : debug mode
---test         : print output to STDOUT
---file=FILE    : XML input filename
---outfile=FILE : XMI output filename
+--help          : show this help
+--verbose       : verbose mode
+--debug         : debug mode
+--test          : print output to STDOUT
+--file=FILE     : XML input filename
+--outfile=FILE  : output filename (single file only)
+--types=FILE    : TypeSystem filename (default: $TEITOK_TYPESYSTEM or inception_typesystem.xml)
+--format=FMT    : output format: xmi (default) or json
+--gzip          : write gzip-compressed output (.xmi.gz / .json.gz)
+--timing        : print the time to build and to write each CAS
+--stream        : read the XML incrementally (for very large files)
+--folder=DIR    : convert all XML files in DIR (recursively)
+--jobs=N        : number of parallel worker processes (default: 1)
+--summary=FILE  : write the per-file conversion results to FILE
 ''')
-	exit()
+		exit()
 
-convert(fname)
\ No newline at end of file
+	jobs = int(cargs.get("jobs", 1))
+	if jobs > 1 and len(fnames) > 1:
+		with ProcessPoolExecutor(max_workers=jobs, initializer=init_types, initargs=(cargs,)) as pool:
+			results = list(pool.map(convert_file, fnames))
+	else:
+		init_types(cargs)
+		results = [convert_file(fname) for fname in fnames]
+
+	if not "batch" in cargs.keys():
+		if results[0][1]:
+			print(results[0][1])
+			sys.exit(1)
+		exit()
+
+	failed = 0
+	summary = []
+	for fname, error in results:
+		if error:
+			failed = failed + 1
+			summary.append(fname + "\tFAILED\t" + error)
+		else:
+			summary.append(fname + "\tOK")
+	if "summary" in cargs.keys():
+		with open(cargs["summary"], "w") as f:
+			f.write("\n".join(summary) + "\n")
+	elif "verbose" in cargs.keys() or failed:
+		print("\n".join(summary))
+	print("Converted " + str(len(results)-failed) + " of " + str(len(results)) + " files, " + str(failed) + " failed")
+	if failed:
+		sys.exit(1)
@@ -0,0 +1,71 @@
+import lxml.etree as etree
+
+# Shared helpers for the scripts that read annotations back into TEITOK/XML files
+
+def scan_document(xmlf, tokxp=None, xmlns=None):
+	# Walk the document once, and collect:
+	# - toks: the //text//tok elements by @id (in document order)
+	# - dtoks: the //text//dtok elements (parts of a multiword token) by @id
+	# - spangrps: the (first) spanGrp for each @type
+	# - spanidx: the spans of each of those spanGrps by @corresp
+	# - annid: the next free ann-N number for new spans
+	doc = {'toks': {}, 'dtoks': {}, 'spangrps': {}, 'spanidx': {}, 'annid': 1}
+	toks = doc['toks']
+	intext = 0
+	grps = []
+	for event, elm in etree.iterwalk(xmlf, events=("start", "end")):
+		if not isinstance(elm.tag, str):
+			continue
+		tag = elm.tag.rsplit("}", 1)[-1]
+		if event == "end":
+			if tag == "text":
+				intext = intext - 1
+			elif tag == "spanGrp":
+				grps.pop()
+			continue
+		if tag == "text":
+			intext = intext + 1
+		elif tag == "tok":
+			tokid = elm.get("id")
+			if intext and tokid is not None and tokxp is None:
+				toks[tokid] = elm
+		elif tag == "dtok":
+			tokid = elm.get("id")
+			if intext and tokid is not None:
+				doc['dtoks'][tokid] = elm
+		elif tag == "spanGrp":
+			grps.append(elm)
+			grptype = elm.get("type")
+			if grptype is not None and not grptype in doc['spangrps'].keys():
+				doc['spangrps'][grptype] = elm
+				doc['spanidx'][grptype] = {}
+		elif tag == "span":
+			spanid = elm.get("id", "")
+			if spanid[0:4] == "ann-" and spanid[4:].isdigit():
+				thisid = int(spanid[4:])
+				if thisid >= doc['annid']:
+					doc['annid'] = thisid + 1
+			corresp = elm.get("corresp")
+			if grps and corresp is not None:
+				grptype = grps[-1].get("type")
+				if doc['spangrps'].get(grptype) is grps[-1] and not corresp in doc['spanidx'][grptype].keys():
+					doc['spanidx'][grptype][corresp] = elm
+
+	# A custom token XPath cannot be evaluated during the walk
+	if tokxp is not None:
+		for tok in xmlf.findall(tokxp, xmlns):
+			tokid = tok.get("id")
+			if tokid is not None:
+				toks[tokid] = tok
+
+	return doc
+
+def get_spangrp(doc, grptype):
+	# Return the spanGrp of a given type with its span index, creating an (unattached) one if needed
+	spangrp = doc['spangrps'].get(grptype)
+	if spangrp is None:
+		spangrp = etree.Element("spanGrp")
+		spangrp.set("type", grptype)
+		doc['spangrps'][grptype] = spangrp
+		doc['spanidx'][grptype] = {}
+	return spangrp, doc['spanidx'][grptype]
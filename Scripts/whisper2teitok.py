@@ -2,69 +2,280 @@ import whisper_timestamped as whisper
 import lxml.etree as etree
 import sys, os, string
 import argparse
+import json, shutil, subprocess, traceback
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 parser = argparse.ArgumentParser(description="Split XML into plain text and stand-off XML mark-up")
-parser.add_argument("infile", help="input audio file name (WAV or MP3)")
-parser.add_argument("-o", "--outfolder", help="folder to place the XML file", default="xmlfiles")
+parser.add_argument("infile", help="input audio file name(s) (WAV or MP3), or a folder with audio files", nargs="+")
+parser.add_argument("-o", "--outfolder", help="folder to place the XML file (files from an input folder keep their subfolders)", default="xmlfiles")
 parser.add_argument("--confs", help="keep confidence scores", action="store_true")
 parser.add_argument("--disfluencies", help="transcribe disfluencies", action="store_true")
 parser.add_argument("--model", help="whisper model to use", default="medium")
 parser.add_argument("--device", help="device to use", default="cpu")
-parser.add_argument("--vad", help="whether to use VAD")
+parser.add_argument("--vad", help="whether to use VAD (true, or a method: silero, auditok)")
 parser.add_argument("-l", "--language", help="language of the audio", type=str)
+parser.add_argument("-j", "--jobs", help="number of parallel worker processes (each loads its own model)", type=int, default=1)
+parser.add_argument("--force", help="transcribe even when the XML file is newer than the audio", action="store_true")
+parser.add_argument("--chunk", help="transcribe in windows of this many seconds (for very long recordings)", type=float)
+parser.add_argument("--overlap", help="overlap between chunks in seconds", type=float, default=5)
+parser.add_argument("--split-jobs", help="split the audio at silences and transcribe the parts in this many processes (CPU only)", type=int, default=1)
 args = parser.parse_args()
 
-audiofile = args.infile
+audioexts = [".wav", ".mp3", ".flac", ".ogg", ".m4a", ".mp4", ".webm"]
 withconf = args.confs
 
-audio = whisper.load_audio(audiofile)
-audioext = os.path.splitext(os.path.basename(audiofile))[1]
-audiobase = os.path.basename(audiofile)
-
-# Determine the model with options
-modelsize = args.model
-modeloptions = {}
-modeloptions['device'] = args.device
-model = whisper.load_model(modelsize, **modeloptions)
-
-# Determine the transcription options
-options = { 'model': audio, 'language': args.language }
-disdect= False
-if args.disfluencies:
-	disdect = True
-
-# Transcribe the audio file
-result = whisper.transcribe(model, audio, language=args.language, detect_disfluencies=disdect)
-
-xmlstring = "<TEI/>"	
-xmlf = etree.ElementTree(etree.fromstring(xmlstring))
-ttheader = etree.Element("teiHeader")
-xmlf.getroot().append(ttheader)
-recst = etree.Element("recordingStmt")
-ttheader.append(recst)
-rec = etree.Element("recording")
-recst.append(rec)
-rec.set("type", "audio")
-media = etree.Element("media")
-rec.append(media)
-media.set("mimeType", "audio/"+audioext[1:])
-media.set("url", "Audio/"+audiobase)
-tttext = etree.Element("text")
-xmlf.getroot().append(tttext)
-if "language" in result.keys():
-	tttext.set("lang", result['language'])
-
-uttcnt = 0
-tokcnt = 0
-
-for seg in result['segments']:
+def load_model():
+	# Determine the model with options
+	global model
+	modelsize = args.model
+	modeloptions = {}
+	modeloptions['device'] = args.device
+	model = whisper.load_model(modelsize, **modeloptions)
+
+def vad_option():
+	# --vad can be a boolean or the name of a VAD method
+	if args.vad is None or args.vad.lower() in ["0", "false", "no"]:
+		return False
+	if args.vad.lower() in ["1", "true", "yes"]:
+		return True
+	return args.vad
+
+def transcribe(audiofile, info, chunkdir):
+	# Generator over the transcribed segments; sets info['language'] before the first segment
+	if args.chunk:
+		yield from transcribe_chunked(audiofile, info, chunkdir)
+		return
+	if args.split_jobs > 1:
+		yield from transcribe_split(audiofile, info)
+		return
+
+	# Determine the transcription options
+	disdect= False
+	if args.disfluencies:
+		disdect = True
+
+	# Transcribe the audio file
+	audio = whisper.load_audio(audiofile)
+	result = whisper.transcribe(model, audio, language=args.language, detect_disfluencies=disdect, vad=vad_option())
+	if "language" in result.keys():
+		info['language'] = result['language']
+	yield from result['segments']
+
+def load_window(audiofile, start, duration, sr=16000):
+	# Decode only a window of the audio file (like whisper.load_audio, but with -ss/-t)
+	cmd = ["ffmpeg", "-nostdin", "-threads", "0", "-ss", str(start), "-t", str(duration), "-i", audiofile, "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr), "-"]
+	out = subprocess.run(cmd, capture_output=True, check=True).stdout
+	return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+def shift_result(result, offset):
+	# Make the times in a chunk result absolute
+	for seg in result['segments']:
+		seg['start'] = seg['start'] + offset
+		seg['end'] = seg['end'] + offset
+		for word in seg['words']:
+			word['start'] = word['start'] + offset
+			word['end'] = word['end'] + offset
+	return result
+
+def trim_segment(seg, low, high):
+	# Keep only the words of a segment that start in [low, high)
+	words = [word for word in seg['words'] if word['start'] >= low and word['start'] < high]
+	if not words:
+		return None
+	if len(words) < len(seg['words']):
+		seg = dict(seg)
+		seg['words'] = words
+		seg['text'] = " " + " ".join([word['text'] for word in words])
+		seg['start'] = words[0]['start']
+		seg['end'] = words[-1]['end']
+	return seg
+
+def chunk_settings(audiofile):
+	# Everything the chunk checkpoints depend on
+	stat = os.stat(audiofile)
+	return {'chunk': args.chunk, 'overlap': args.overlap, 'model': args.model, 'language': args.language,
+		'disfluencies': args.disfluencies, 'vad': args.vad, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def transcribe_chunked(audiofile, info, chunkdir):
+	# Transcribe a long recording in overlapping windows, keeping a checkpoint of each finished window
+	disdect= False
+	if args.disfluencies:
+		disdect = True
+
+	step = args.chunk - args.overlap
+	if step <= 0:
+		raise ValueError("--overlap should be smaller than --chunk")
+
+	# Only reuse checkpoints written with the same settings for the same audio
+	settings = chunk_settings(audiofile)
+	settingsfile = os.path.join(chunkdir, "settings.json")
+	if os.path.isdir(chunkdir):
+		oldsettings = None
+		if os.path.exists(settingsfile):
+			with open(settingsfile) as f:
+				oldsettings = json.load(f)
+		if oldsettings != settings:
+			shutil.rmtree(chunkdir)
+		else:
+			done = len([name for name in os.listdir(chunkdir) if name.startswith("chunk-") and name.endswith(".json")])
+			if done:
+				print("resuming " + audiofile + " - " + str(done) + " windows already transcribed")
+	if not os.path.isdir(chunkdir):
+		os.makedirs(chunkdir)
+		with open(settingsfile, "w") as f:
+			json.dump(settings, f)
+
+	# Each window keeps the words up to the middle of its overlap with the next one; the words
+	# after that are held back until we know whether there is a next window
+	pending = []
+	chunkcnt = 0
+	while True:
+		start = chunkcnt * step
+		chunkfile = os.path.join(chunkdir, "chunk-" + str(chunkcnt) + ".json")
+		if os.path.exists(chunkfile):
+			with open(chunkfile) as f:
+				chunk = json.load(f)
+		else:
+			audio = load_window(audiofile, start, args.chunk)
+			if len(audio) == 0:
+				break
+			result = whisper.transcribe(model, audio, language=args.language, detect_disfluencies=disdect, vad=vad_option())
+			chunk = {'start': start, 'duration': len(audio)/16000, 'result': shift_result(result, start)}
+			with open(chunkfile + ".tmp", "w") as f:
+				json.dump(chunk, f, default=float)
+			os.replace(chunkfile + ".tmp", chunkfile)
+		if chunkcnt == 0 and "language" in chunk['result'].keys():
+			info['language'] = chunk['result']['language']
+
+		# A window shorter than requested (allowing for rounding by ffmpeg) is the last one
+		islast = chunk['duration'] < args.chunk - 1
+		low = 0
+		if chunkcnt > 0:
+			low = start + args.overlap/2
+		high = float("inf")
+		if not islast:
+			high = start + step + args.overlap/2
+		pending = []
+		for seg in chunk['result']['segments']:
+			kept = trim_segment(seg, low, high)
+			if kept is not None:
+				yield kept
+			held = trim_segment(seg, high, float("inf"))
+			if held is not None:
+				pending.append(held)
+		chunkcnt = chunkcnt + 1
+		if islast:
+			break
+
+	# The previous window turned out to be the last one
+	yield from pending
+
+def speech_regions(audio, sr=16000, maxlen=30, minsilence=0.5):
+	# Split the audio at silences (low energy stretches) into regions of about maxlen seconds
+	frame = int(0.03 * sr)
+	nframes = len(audio) // frame
+	if nframes == 0:
+		return [(0, len(audio))]
+	energy = np.sqrt(np.mean(audio[:nframes*frame].reshape(nframes, frame)**2, axis=1))
+	low = np.percentile(energy, 20)
+	high = np.percentile(energy, 95)
+	silent = energy <= low + 0.1 * (high - low)
+
+	# Candidate cut points: the middle of each long enough silence
+	cuts = []
+	minframes = int(minsilence * sr / frame)
+	i = 0
+	while i < nframes:
+		if silent[i]:
+			j = i
+			while j < nframes and silent[j]:
+				j = j + 1
+			if j - i >= minframes:
+				cuts.append((i + j) // 2)
+			i = j
+		else:
+			i = i + 1
+
+	# Group the pieces between cut points into regions, and drop regions without speech
+	regions = []
+	start = 0
+	maxframes = int(maxlen * sr / frame)
+	bounds = cuts + [nframes]
+	for k, cut in enumerate(bounds):
+		nextcut = bounds[k+1] if k + 1 < len(bounds) else None
+		if nextcut is not None and nextcut - start <= maxframes:
+			continue
+		if not silent[start:cut].all():
+			regions.append((start * frame, cut * frame))
+		start = cut
+	if regions:
+		regions[-1] = (regions[-1][0], max(regions[-1][1], len(audio)))
+	return regions
+
+def init_split_worker(nthreads):
+	# Workers inherit the model (and the audio) from the parent through fork
+	import torch
+	torch.set_num_threads(nthreads)
+
+def transcribe_region(region):
+	disdect= False
+	if args.disfluencies:
+		disdect = True
+	start, end = region
+	result = whisper.transcribe(model, splitaudio[start:end], language=args.language, detect_disfluencies=disdect, vad=vad_option())
+	return shift_result(result, start / 16000)
+
+def transcribe_split(audiofile, info):
+	# Transcribe the speech regions of a file in parallel, and yield the segments in order
+	global splitaudio
+	splitaudio = whisper.load_audio(audiofile)
+	regions = speech_regions(splitaudio)
+	# Share the CPUs between all split workers of all (--jobs) files
+	nthreads = max(1, multiprocessing.cpu_count() // (args.split_jobs * max(1, args.jobs)))
+	ctx = multiprocessing.get_context("fork")
+	with ctx.Pool(args.split_jobs, initializer=init_split_worker, initargs=(nthreads,)) as pool:
+		for result in pool.imap(transcribe_region, regions):
+			if not "language" in info.keys() and "language" in result.keys():
+				info['language'] = result['language']
+			yield from result['segments']
+	splitaudio = None
+
+def xmlfilename(audiofile, root=None):
+	# Files found in a folder keep their subfolder below the output folder
+	name = os.path.splitext(os.path.basename(audiofile))[0] + ".xml"
+	if root is not None:
+		name = os.path.join(os.path.relpath(os.path.dirname(audiofile), root), name)
+	return os.path.normpath(os.path.join(args.outfolder, name))
+
+def chunkfolder(xmlfile):
+	return os.path.splitext(xmlfile)[0] + ".chunks"
+
+def make_header(audiofile):
+	audioext = os.path.splitext(os.path.basename(audiofile))[1]
+	audiobase = os.path.basename(audiofile)
+
+	ttheader = etree.Element("teiHeader")
+	recst = etree.Element("recordingStmt")
+	ttheader.append(recst)
+	rec = etree.Element("recording")
+	recst.append(rec)
+	rec.set("type", "audio")
+	media = etree.Element("media")
+	rec.append(media)
+	media.set("mimeType", "audio/"+audioext[1:])
+	media.set("url", "Audio/"+audiobase)
+	return ttheader
+
+def segment2u(seg, counts):
+	# Convert a transcribed segment into a <u> with its <tok> elements
 	utt = etree.Element("u")
-	tttext.append(utt)
 	utt.set("text", str(seg['text']))
 	utt.set("start", str(seg['start']))
 	utt.set("end", str(seg['end']))
-	uttcnt = uttcnt + 1
-	utt.set("id", "u-"+str(uttcnt))
+	counts['utt'] = counts['utt'] + 1
+	utt.set("id", "u-"+str(counts['utt']))
 	if withconf and "conf" in seg:
 		utt.set("conf", str(seg['conf']))
 	for word in seg['words']:
@@ -73,8 +284,8 @@ for seg in result['segments']:
 		tok.text = word['text']
 		tok.set("start", str(word['start']))
 		tok.set("end", str(word['end']))
-		tokcnt = tokcnt + 1
-		tok.set("id", "w-"+str(tokcnt))
+		counts['tok'] = counts['tok'] + 1
+		tok.set("id", "w-"+str(counts['tok']))
 		if withconf and "conf" in word:
 			tok.set("conf", str(word['conf']))
 		tok.tail = " "
@@ -85,22 +296,112 @@ for seg in result['segments']:
 		    tok.text = ""
 		else:
 			# Split off punctuation marks
-			last = True
-			while tok.text[-1] in string.punctuation:
-				old = tok.text
-				punct = etree.Element("tok")
-				punct.text = old[-1]
-				tokcnt = tokcnt + 1
-				punct.set("id", "w-"+str(tokcnt))
-				index = list(utt).index(tok)
-				utt.insert(index+1, punct)
-				tok.text = old[0:-1]
-				if last:
-					punct.tail = " "
-					tok.tail = ""
-				last = False
+			text = tok.text
+			cut = len(text)
+			while cut > 1 and text[cut-1] in string.punctuation:
+				cut = cut - 1
+			if cut < len(text):
+				tok.text = text[0:cut]
+				tok.tail = ""
+				for char in text[cut:]:
+					punct = etree.SubElement(utt, "tok")
+					punct.text = char
+					counts['tok'] = counts['tok'] + 1
+					punct.set("id", "w-"+str(counts['tok']))
+				punct.tail = " "
 	utt.tail = "\n"
+	return utt
+
+def convert(audiofile, xmlfile):
+	# Transcribe a single audio file, writing each <u> to the TEI file as soon as it is done
+	info = {}
+	segments = transcribe(audiofile, info, chunkfolder(xmlfile))
+	seg = next(segments, None)
+	counts = {'utt': 0, 'tok': 0}
+
+	# Stream into a .part file (which can be followed while it grows), and only give it the
+	# final name once the transcription is complete: an interrupted run leaves no XML file
+	os.makedirs(os.path.dirname(xmlfile) or ".", exist_ok=True)
+	partfile = xmlfile + ".part"
+	with etree.xmlfile(partfile, encoding="UTF-8") as xf:
+		xf.write_declaration()
+		with xf.element("TEI"):
+			xf.write(make_header(audiofile))
+			textatts = {}
+			if "language" in info.keys():
+				textatts['lang'] = info['language']
+			with xf.element("text", textatts):
+				while seg is not None:
+					xf.write(segment2u(seg, counts))
+					xf.flush()
+					seg = next(segments, None)
+	os.replace(partfile, xmlfile)
+
+	# The checkpoints of a chunked transcription are no longer needed
+	if os.path.isdir(chunkfolder(xmlfile)):
+		shutil.rmtree(chunkfolder(xmlfile))
+	return "output written to " + xmlfile
+
+def convert_safe(audiofile, xmlfile):
+	# Worker for the batch mode: report errors (with their traceback) instead of stopping
+	try:
+		return (convert(audiofile, xmlfile), False)
+	except Exception as e:
+		print(audiofile + ":\n" + traceback.format_exc(), file=sys.stderr)
+		return (audiofile + ": failed - " + str(e), True)
+
+if __name__ == "__main__":
+	# The split workers are forked from a process that holds the model, which CUDA does not support
+	if args.split_jobs > 1 and args.device != "cpu" and not args.chunk:
+		print("--split-jobs can only be used with --device cpu")
+		sys.exit(1)
+
+	# Collect the audio files, skipping those with an up-to-date XML file
+	audiofiles = []
+	for infile in args.infile:
+		if os.path.isdir(infile):
+			for root, dirs, files in os.walk(infile):
+				dirs.sort()
+				for name in sorted(files):
+					if os.path.splitext(name)[1].lower() in audioexts:
+						audiofile = os.path.join(root, name)
+						audiofiles.append((audiofile, xmlfilename(audiofile, infile)))
+		else:
+			audiofiles.append((infile, xmlfilename(infile)))
+
+	# Two audio files should never write to the same XML file (or share its checkpoints)
+	sources = {}
+	for audiofile, xmlfile in audiofiles:
+		if xmlfile in sources:
+			print("Both " + sources[xmlfile] + " and " + audiofile + " would be written to " + xmlfile)
+			sys.exit(1)
+		sources[xmlfile] = audiofile
+
+	todo = []
+	for audiofile, xmlfile in audiofiles:
+		if not args.force and os.path.exists(xmlfile) and os.path.getmtime(xmlfile) > os.path.getmtime(audiofile):
+			print("skipping " + audiofile + " - " + xmlfile + " is up to date")
+			continue
+		todo.append((audiofile, xmlfile))
+
+	if len(todo) == 1:
+		load_model()
+		print(convert(*todo[0]))
+		sys.exit()
 
-xmlfile = args.outfolder + '/' + os.path.splitext(os.path.basename(audiofile))[0] + ".xml"
-print("output written to " + xmlfile)
-xmlf.write(xmlfile,encoding="UTF-8")	
+	failed = 0
+	if args.jobs > 1 and len(todo) > 1:
+		with ProcessPoolExecutor(max_workers=args.jobs, initializer=load_model) as pool:
+			results = pool.map(convert_safe, [job[0] for job in todo], [job[1] for job in todo])
+			for message, error in results:
+				print(message)
+				failed = failed + error
+	elif todo:
+		load_model()
+		for audiofile, xmlfile in todo:
+			message, error = convert_safe(audiofile, xmlfile)
+			print(message)
+			failed = failed + error
+	if failed:
+		print(str(failed) + " of " + str(len(todo)) + " files failed")
+		sys.exit(1)